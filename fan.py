@@ -3,36 +3,148 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import array, bisect, heapq
 from . import pulse_counter
 
 FAN_MIN_TIME = 0.100
+FAN_CURVE_STEPS = 1023
+SPEED_DEADBAND_TIME = 5.0
+IMMEDIATE_TIME = 0.050
+RAMP_LEAD_TIME = 0.250
+QUEUE_COMPACT_COUNT = 32
+TACH_SAMPLE_TIME = 1.0
+TACH_POLLS_PER_EDGE = 2
+CALIBRATE_SETTLE_RPM = 0.01
+CALIBRATE_STOP_RPM = 0.05
+CALIBRATE_MAX_SAMPLES = 10
+# Fan sections whose speed is only set by commands.  Others, such as
+# temperature_fan and heater_fan, run their own control of the fan.
+COMMANDED_FAN_TYPES = ('fan', 'fan_generic')
+
+######################################################################
+# Fan transfer curve
+######################################################################
+
+def _default_curve(pwm_fan):
+    if pwm_fan:
+        return lambda value: value
+    #If fan is not a 4 wire fan with built-in PWM circuitry then
+    #scale the value so no PWM below 20% duty cycle.
+    #This complies with Intel standard of PWM fans (the defacto standard)
+    #See page 14 of "intel-4wire-pwn-fans-specs.pdf"
+    #Effectively "normalizes" PWM duty cycle vs. fan RPM
+    return lambda value: .2 + .8 * value
+
+def _interpolate_curve(points):
+    speeds = [p[0] for p in points]
+    duties = [p[1] for p in points]
+    def curve(value):
+        for i in range(1, len(speeds)):
+            if value <= speeds[i]:
+                s0, s1 = speeds[i-1], speeds[i]
+                d0, d1 = duties[i-1], duties[i]
+                return d0 + (d1 - d0) * (max(value, s0) - s0) / (s1 - s0)
+        return duties[-1]
+    return curve
+
+# fan_curve points for an rpm_curve: duties (fractions of max_power) at
+# 1/N .. N/N of the full speed RPM, with lower speeds at the first duty
+def _rpm_curve_points(duties):
+    count = len(duties)
+    return ((0., duties[0]),) + tuple(((i + 1) / count, duty)
+                                      for i, duty in enumerate(duties))
+
+# Compiled tables are shared between fans with identical settings
+_curve_cache = {}
+
+# Table of duty (max_power applied) for requested speeds rounded to
+# 1/FAN_CURVE_STEPS.  A speed of zero, and speeds below the first
+# fan_curve point, turn the fan off.
+def compile_fan_curve(points, pwm_fan, max_power):
+    key = (points, pwm_fan, max_power)
+    table = _curve_cache.get(key)
+    if table is not None:
+        return table
+    if points is None:
+        curve = _default_curve(pwm_fan)
+        start = 1
+    else:
+        curve = _interpolate_curve(points)
+        start = max(1, int(points[0][0] * FAN_CURVE_STEPS + .5))
+    table = array.array('d', [0.] * start)
+    for i in range(start, FAN_CURVE_STEPS + 1):
+        fan_speed = curve(i / FAN_CURVE_STEPS)
+        table.append(max(0., min(max_power, fan_speed * max_power)))
+    _curve_cache[key] = table
+    return table
 
 class Fan:
+    # Compact layout - many fans may be configured on small hosts
+    __slots__ = ('printer', 'last_fan_value', 'last_fan_time', 'fan_name',
+                 'slicer_fan_num', 'max_power', 'kick_start_time',
+                 'off_below', 'mcu_fan', 'pwm_fan', 'enable_pin',
+                 'tachometer', 'printer_fan', 'queued_speeds',
+                 'queued_index', 'run_queued_command', 'held_time', 'held_speed',
+                 'toolhead', 'cycle_time', 'hardware_pwm', 'pwm_max',
+                 'last_pwm_value', 'fan_curve', 'reactor', 'speed_deadband',
+                 'min_update_interval', 'update_timer', 'pending_speed',
+                 'pending_time', 'immediate', 'stale_commands', 'ramp_rate',
+                 'ramp_max_steps', 'ramp_timer', 'ramp_steps', 'ramp_index',
+                 'ramp_count', 'ramp_duty', 'kick_profile', 'kick_start_rpm',
+                 'fan_schedule', 'scheduled', 'schedule_gen', 'rpm_control',
+                 'kick_below', 'kick_count')
     def __init__(self, config, default_shutdown_speed=0.):
         self.printer = config.get_printer()
-        self.config = config
+        self.reactor = self.printer.get_reactor()
+        self.printer_fan = None
         self.last_fan_value = 0.
         self.last_fan_time = 0.
         self.fan_name = config.get_name().split()
+        # Speeds of commands in the lookahead queue, all run by the same
+        # bound callback, and a superseded value awaiting the next.  A
+        # list with a read index is far smaller than a deque.
+        self.toolhead = None
+        self.queued_speeds = []
+        self.queued_index = 0
+        self.run_queued_command = self._run_queued_command
+        self.held_time = 0.
+        self.held_speed = None
+        # Timed changes waiting in the shared FanSchedule
+        self.fan_schedule = None
+        self.scheduled = self.schedule_gen = 0
+        # Queued commands superseded by an immediate request
+        self.stale_commands = 0
 
         # Read config
-        self.slicer_fan_num = self.config.getint('slicer_fan_number', default=None)
+        self.slicer_fan_num = config.getint('slicer_fan_number', default=None)
         self.max_power = config.getfloat('max_power', 1., above=0., maxval=1.)
         self.kick_start_time = config.getfloat('kick_start_time', 0.1,
                                                minval=0.)
+        self.kick_start_rpm = config.getfloat('kick_start_rpm', 0.,
+                                              minval=0.)
         self.off_below = config.getfloat('off_below', default=0.,
                                          minval=0., maxval=1.)
-        cycle_time = config.getfloat('cycle_time', 0.010, above=0.)
-        hardware_pwm = config.getboolean('hardware_pwm', False)
+        self.cycle_time = config.getfloat('cycle_time', 0.010, above=0.)
+        self.hardware_pwm = config.getboolean('hardware_pwm', False)
+        self.speed_deadband = config.getfloat('speed_deadband', 0.,
+                                              minval=0., maxval=1.)
+        self.min_update_interval = config.getfloat('min_update_interval', 0.,
+                                                   minval=0.)
+        self.immediate = config.getboolean('immediate', False)
+        self.ramp_rate = config.getfloat('ramp_rate', 0., minval=0.)
+        self.ramp_max_steps = config.getint('ramp_max_steps', 10, minval=2)
         shutdown_speed = config.getfloat(
             'shutdown_speed', default_shutdown_speed, minval=0., maxval=1.)
         # Setup pwm object
         ppins = self.printer.lookup_object('pins')
         self.mcu_fan = ppins.setup_pin('pwm', config.get('pin'))
         self.mcu_fan.setup_max_duration(0.)
-        self.mcu_fan.setup_cycle_time(cycle_time, hardware_pwm)
+        self.mcu_fan.setup_cycle_time(self.cycle_time, self.hardware_pwm)
         shutdown_power = max(0., min(self.max_power, shutdown_speed))
         self.mcu_fan.setup_start_value(0., shutdown_power)
+        # PWM resolution is known once the mcu is identified
+        self.pwm_max = None
+        self.last_pwm_value = 0.
         self.pwm_fan = False
         self.enable_pin = None
         enable_pin = config.get('enable_pin', None)
@@ -41,28 +153,100 @@ class Fan:
             self.enable_pin.setup_max_duration(0.)
             #Enable 4 wire fan control, changes PWM curve below
             self.pwm_fan = True
+        # Requested speed to duty lookup table
+        points = config.getlists('fan_curve', None, seps=(',', '\n'),
+                                 count=2, parser=float)
+        if points is not None:
+            points = tuple(sorted(points))
+            speeds = [p[0] for p in points]
+            if (len(points) < 2 or len(set(speeds)) != len(speeds)
+                or min(min(p) for p in points) < 0.
+                or max(max(p) for p in points) > 1.):
+                raise config.error(
+                    "fan_curve in section '%s' needs at least two points"
+                    " with unique speeds, all values from 0.0 to 1.0"
+                    % (config.get_name(),))
+        # A FAN_CALIBRATE result takes the place of fan_curve
+        rpm_curve = config.getlists('rpm_curve', None, parser=float)
+        if rpm_curve is not None:
+            if (len(rpm_curve) < 2 or min(rpm_curve) < 0.
+                or max(rpm_curve) > 1.
+                or list(rpm_curve) != sorted(rpm_curve)):
+                raise config.error(
+                    "rpm_curve in section '%s' needs at least two values"
+                    " from 0.0 to 1.0 in non-decreasing order"
+                    % (config.get_name(),))
+            points = _rpm_curve_points(rpm_curve)
+        self.fan_curve = compile_fan_curve(points, self.pwm_fan,
+                                           self.max_power)
+        # Duties from start_duty up start a stopped fan without a kick
+        self.kick_below = self.max_power * config.getfloat(
+            'start_duty', 1., above=0., maxval=1.)
+        # Kick-start as (duty, duration) steps, and kick-starts sent
+        self.kick_count = 0
+        profile = config.getlists('kick_start_profile', None,
+                                  seps=(',', '\n'), count=2, parser=float)
+        if profile is None:
+            self.kick_profile = ()
+            if self.kick_start_time:
+                self.kick_profile = ((self.max_power, self.kick_start_time),)
+        else:
+            if any(not 0. < speed <= 1. or duration <= 0.
+                   for speed, duration in profile):
+                raise config.error(
+                    "kick_start_profile in section '%s' needs"
+                    " 'speed, duration' pairs with a speed above 0.0 up to"
+                    " 1.0 and a positive duration" % (config.get_name(),))
+            self.kick_profile = tuple((speed * self.max_power, duration)
+                                      for speed, duration in profile)
+        # Deferred updates from speed_deadband / min_update_interval
+        self.update_timer = None
+        self.pending_speed = None
+        self.pending_time = 0.
+        if self.speed_deadband or self.min_update_interval:
+            self.update_timer = self.reactor.register_timer(
+                self._flush_pending_speed)
+        # Ramp steps as (print_time, duty) pairs, sent by ramp_timer
+        self.ramp_timer = self.ramp_steps = None
+        self.ramp_index = self.ramp_count = 0
+        self.ramp_duty = 0.
+        if self.ramp_rate:
+            self.ramp_steps = array.array('d',
+                                          [0.] * (2 * self.ramp_max_steps))
+            self.ramp_timer = self.reactor.register_timer(self._send_ramp)
         # Setup tachometer
         self.tachometer = FanTachometer(config, self)
+        self.rpm_control = None
+        if self.tachometer.ppr is None:
+            # Without a tachometer every kick-start runs in full
+            self.kick_start_rpm = 0.
+        else:
+            self.rpm_control = FanRpmControl(config, self)
         # Register callbacks
         self.printer.register_event_handler("gcode:request_restart",
                                             self._handle_request_restart)
 
         if len(self.fan_name)>1:
-            gcode = self.printer.lookup_object("gcode")
-            gcode.register_mux_command("SET_FAN_SPEED", "FAN",
-                                    self.fan_name[1],
-                                    self.cmd_SET_FAN_SPEED,
-                                    desc=self.cmd_SET_FAN_SPEED_help)
+            fan_speed_cmd = self.printer.lookup_object('set_fan_speed', None)
+            if fan_speed_cmd is None:
+                fan_speed_cmd = SetFanSpeedCommand(self.printer)
+                self.printer.add_object('set_fan_speed', fan_speed_cmd)
+            fan_speed_cmd.add_fan(self.fan_name[1], self)
         self.printer.register_event_handler("klippy:connect", self.handle_connect)
 
     def handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
         try:
             self.printer_fan = self.printer.lookup_object('fan')
         except Exception:
             self.printer_fan = None
+        # Match the mcu's duty cycle quantization (see MCU_pwm)
+        mcu = self.get_mcu()
+        if self.hardware_pwm:
+            self.pwm_max = mcu.get_constant_float("PWM_MAX")
+        else:
+            self.pwm_max = float(mcu.seconds_to_clock(self.cycle_time))
 
-        self.slicer_fan_num = (
-            self.config.getint('slicer_fan_number', default=None))
         if self.slicer_fan_num is not None:
             (self.printer.lookup_object('fan')
              .add_fan(self.slicer_fan_num, self))
@@ -75,66 +259,295 @@ class Fan:
     def get_mcu(self):
         return self.mcu_fan.get_mcu()
 
-    cmd_SET_FAN_SPEED_help = "Sets the speed of a fan"
-
-    def cmd_SET_FAN_SPEED(self, gcmd):
-        speed = gcmd.get_float('SPEED', 0.)
-        self.set_speed_from_command(speed)
-
     def set_speed(self, print_time, value):
-        #Check to see if 4 wire fan
-        if not self.pwm_fan:
-            #If fan is not a 4 wire fan with built-in PWM circuitry then
-            #scale the value so no PWM below 20% duty cycle.
-            #This complies with Intel standard of PWM fans (the defacto standard)
-            #See page 14 of "intel-4wire-pwn-fans-specs.pdf"
-            #Effectively "normalizes" PWM duty cycle vs. fan RPM
-            fan_speed = .2 + .8 * value
-            fan_speed = 0 if fan_speed <= .2 else fan_speed
-        else:
-            fan_speed = value
+        if self.update_timer is not None and self._defer_speed(print_time,
+                                                               value):
+            return
+        self._apply_speed(print_time, value)
+    def _defer_speed(self, print_time, value):
+        last_value = self.last_fan_value
+        if value == last_value:
+            self.pending_speed = None
+            return True
+        hold = self.min_update_interval
+        if (last_value and value
+            and abs(value - last_value) < self.speed_deadband):
+            # Small changes are batched but still applied eventually
+            hold = max(hold, SPEED_DEADBAND_TIME)
+        update_time = self.last_fan_time + hold
+        if print_time >= update_time:
+            self.pending_speed = None
+            return False
+        # Hold the latest request until update_time
+        self.pending_speed = value
+        self.pending_time = update_time
+        mcu = self.get_mcu()
+        curtime = self.reactor.monotonic()
+        est_print_time = mcu.estimated_print_time(curtime)
+        waketime = curtime + update_time - FAN_MIN_TIME - est_print_time
+        self.reactor.update_timer(self.update_timer, waketime)
+        return True
+    def _flush_pending_speed(self, eventtime):
+        value = self.pending_speed
+        if value is not None:
+            self.pending_speed = None
+            est_print_time = self.get_mcu().estimated_print_time(eventtime)
+            print_time = max(self.pending_time,
+                             est_print_time + FAN_MIN_TIME)
+            self._apply_speed(print_time, value)
+        return self.reactor.NEVER
+    def _apply_speed(self, print_time, value, ramp=True):
+        if value == self.last_fan_value:
+            return
         if value < self.off_below:
             fan_speed = 0.
-        fan_speed = max(0., min(self.max_power, fan_speed * self.max_power))
-        if value == self.last_fan_value:
+        else:
+            #Curve and max_power are precomputed in fan_curve.  Clamp
+            #before converting so inf and nan map to full power and off.
+            if value >= 1.:
+                index = FAN_CURVE_STEPS
+            elif value > 0.:
+                index = int(value * FAN_CURVE_STEPS + .5)
+            else:
+                index = 0
+            fan_speed = self.fan_curve[index]
+        pwm_value = fan_speed
+        if self.pwm_max:
+            pwm_value = int(fan_speed * self.pwm_max + 0.5)
+        if (pwm_value == self.last_pwm_value
+            and (not self.enable_pin
+                 or (value > 0) == (self.last_fan_value > 0))):
+            # No change to the value the mcu would output
+            self.last_fan_value = value
             return
         print_time = max(self.last_fan_time + FAN_MIN_TIME, print_time)
+        kick = 0.
+        if (fan_speed and fan_speed < self.kick_below and self.kick_profile
+            and (not self.last_fan_value
+                 or fan_speed - self.last_fan_value > .5)):
+            kick = 1.
+            if self.kick_start_rpm:
+                kick = self._kick_scale(print_time)
+        steps = 1
+        if self.ramp_rate:
+            # A new request replaces the unsent steps of an active ramp
+            self.ramp_count = 0
+            if ramp and not kick:
+                steps = self._ramp_step_count(fan_speed)
         if self.enable_pin:
             if value > 0 and self.last_fan_value == 0:
                 self.enable_pin.set_digital(print_time, 1)
-            elif value == 0 and self.last_fan_value > 0:
+            elif value == 0 and self.last_fan_value > 0 and steps == 1:
+                # A ramp to zero disables the fan after its last step
                 self.enable_pin.set_digital(print_time, 0)
-        if (fan_speed and fan_speed < self.max_power and self.kick_start_time
-            and (not self.last_fan_value or fan_speed - self.last_fan_value > .5)):
-            # Run fan at full speed for specified kick_start_time
-            self.mcu_fan.set_pwm(print_time, self.max_power)
-            print_time += self.kick_start_time
-        self.mcu_fan.set_pwm(print_time, fan_speed)
-        self.last_fan_time = print_time
+        if kick:
+            # Run fan through the kick_start_profile (by default at full
+            # speed for kick_start_time)
+            self.kick_count += 1
+            for kick_duty, duration in self.kick_profile:
+                self.mcu_fan.set_pwm(print_time, kick_duty)
+                print_time += duration * kick
+        self.last_pwm_value = pwm_value
         #Leave last_fan_speed as value so UI doesn't see the scaling
         self.last_fan_value = value
-    def set_speed_from_command(self, value):
-        toolhead = self.printer.lookup_object('toolhead')
-        toolhead.register_lookahead_callback((lambda pt:
-                                              self.set_speed(pt, value)))
+        if steps > 1:
+            self._start_ramp(print_time, fan_speed, steps)
+            return
+        self.mcu_fan.set_pwm(print_time, fan_speed)
+        self.last_fan_time = print_time
+        self.ramp_duty = fan_speed
+    def set_duty_now(self, duty):
+        # Raw duty for FAN_CALIBRATE, without fan_curve, kick-start, ramps
+        # or update batching.  The speed stays reported as 0 so a duty
+        # below the stall duty is not reported as tach loss.
+        curtime = self.reactor.monotonic()
+        est_print_time = self.get_mcu().estimated_print_time(curtime)
+        print_time = max(self.last_fan_time + FAN_MIN_TIME,
+                         est_print_time + IMMEDIATE_TIME)
+        self.ramp_count = 0
+        if self.enable_pin and (duty > 0.) != (self.ramp_duty > 0.):
+            self.enable_pin.set_digital(print_time, 1 if duty > 0. else 0)
+        self.mcu_fan.set_pwm(print_time, duty)
+        self.last_fan_time = print_time
+        self.ramp_duty = duty
+        self.last_fan_value = 0.
+        self.last_pwm_value = None
+    def _kick_scale(self, print_time):
+        # A rotor that is still spinning needs a shorter kick, or none.
+        # The rpm is averaged over TACH_SAMPLE_TIME and the rotor slows
+        # down while the fan is off, so a reading says nothing about a
+        # kick scheduled further ahead than that.
+        curtime = self.reactor.monotonic()
+        est_print_time = self.get_mcu().estimated_print_time(curtime)
+        if print_time - est_print_time > TACH_SAMPLE_TIME:
+            return 1.
+        rpm = self.tachometer.get_rpm()
+        return max(0., 1. - rpm / self.kick_start_rpm)
+    def _ramp_step_count(self, fan_speed):
+        # Steps are at least FAN_MIN_TIME apart and change the mcu duty
+        delta = abs(fan_speed - self.ramp_duty)
+        steps = int(delta / (self.ramp_rate * FAN_MIN_TIME))
+        if self.pwm_max:
+            steps = min(steps, int(delta * self.pwm_max))
+        return max(1, min(self.ramp_max_steps, steps))
+    def _start_ramp(self, print_time, fan_speed, steps):
+        start = self.ramp_duty
+        delta = fan_speed - start
+        interval = abs(delta) / self.ramp_rate / steps
+        ramp_steps = self.ramp_steps
+        for i in range(steps):
+            ramp_steps[2*i] = print_time + i * interval
+            ramp_steps[2*i + 1] = start + delta * (i + 1) / steps
+        ramp_steps[2*steps - 1] = fan_speed
+        self.ramp_index = 0
+        self.ramp_count = steps
+        # The first step is due now, the rest are sent shortly before
+        # their print_time so a later request can still replace them
+        self._send_ramp(self.reactor.monotonic())
+    def _send_ramp(self, eventtime):
+        est_print_time = self.get_mcu().estimated_print_time(eventtime)
+        ramp_steps = self.ramp_steps
+        while self.ramp_index < self.ramp_count:
+            step_time = ramp_steps[2*self.ramp_index]
+            waketime = eventtime + step_time - RAMP_LEAD_TIME - est_print_time
+            if self.ramp_index and waketime > eventtime:
+                self.reactor.update_timer(self.ramp_timer, waketime)
+                return waketime
+            duty = ramp_steps[2*self.ramp_index + 1]
+            self.mcu_fan.set_pwm(step_time, duty)
+            self.last_fan_time = step_time
+            self.ramp_duty = duty
+            self.ramp_index += 1
+        if self.ramp_count and self.enable_pin and not self.last_fan_value:
+            self.enable_pin.set_digital(self.last_fan_time, 0)
+        self.ramp_count = 0
+        return self.reactor.NEVER
+    def set_speed_from_command(self, value, immediate=None):
+        if immediate is None:
+            immediate = self.immediate
+        if immediate:
+            self.set_speed_immediate(value)
+            return
+        self.queue_speed(value)
+        self.toolhead.register_lookahead_callback(self.run_queued_command)
+    def queue_speed(self, value):
+        # Caller registers run_queued_command to apply the value
+        if self.scheduled:
+            self.cancel_schedule()
+        self.queued_speeds.append(value)
+    def set_speed_immediate(self, value):
+        if self.scheduled:
+            self.cancel_schedule()
+        self._set_speed_now(value)
+    def _set_speed_now(self, value):
+        # Schedule just ahead of the mcu instead of after queued moves.
+        # Commands still in the lookahead queue were issued earlier, so
+        # they must not override this value once flushed.
+        self.stale_commands = len(self.queued_speeds) - self.queued_index
+        self.held_speed = None
+        curtime = self.reactor.monotonic()
+        est_print_time = self.get_mcu().estimated_print_time(curtime)
+        self.set_speed(est_print_time + IMMEDIATE_TIME, value)
+    def schedule_speed(self, delay, value):
+        # Set the speed delay seconds from now, unless a newer command
+        # (or cancel_schedule) replaces it first
+        if self.fan_schedule is None:
+            self.fan_schedule = self.printer.lookup_object('fan_schedule',
+                                                           None)
+            if self.fan_schedule is None:
+                self.fan_schedule = FanSchedule(self.printer)
+                self.printer.add_object('fan_schedule', self.fan_schedule)
+        self.scheduled += 1
+        self.fan_schedule.add(self.reactor.monotonic() + delay, self, value)
+    def cancel_schedule(self):
+        # Entries of an older generation are skipped by FanSchedule
+        self.schedule_gen += 1
+        self.scheduled = 0
+        if self.rpm_control is not None:
+            self.rpm_control.stop()
+    def set_rpm(self, rpm):
+        # RPM control counts as a timed change, so any later speed
+        # command ends it through cancel_schedule()
+        self.cancel_schedule()
+        if not rpm:
+            self._set_speed_now(0.)
+            return
+        self.scheduled += 1
+        self.rpm_control.start(rpm)
+    def _run_queued_command(self, print_time):
+        queued_speeds = self.queued_speeds
+        index = self.queued_index
+        value = queued_speeds[index]
+        index += 1
+        if index == len(queued_speeds):
+            # Queue drained - reuse the list from the start
+            queued_speeds.clear()
+            self.queued_index = 0
+        elif index >= QUEUE_COMPACT_COUNT:
+            # Commands keep arriving before the queue drains - drop the
+            # values already run so the list stays bounded
+            del queued_speeds[:index]
+            self.queued_index = 0
+        else:
+            self.queued_index = index
+        if self.stale_commands:
+            self.stale_commands -= 1
+            return
+        held_speed = self.held_speed
+        if held_speed is not None:
+            self.held_speed = None
+            # Only send a superseded value if it would be held for at
+            # least FAN_MIN_TIME before the next one
+            if print_time - self.held_time >= FAN_MIN_TIME:
+                self.set_speed(self.held_time, held_speed)
+        if queued_speeds:
+            # A newer command is queued - hold this value until it is
+            # known whether that command supersedes it
+            self.held_time = print_time
+            self.held_speed = value
+            return
+        self.set_speed(print_time, value)
     def _handle_request_restart(self, print_time):
-        self.set_speed(print_time, 0.)
+        self.pending_speed = None
+        if self.ramp_count:
+            # Abandon the ramp at the duty already sent so the fan and
+            # its enable pin are switched off right away
+            self.ramp_count = 0
+            self.last_fan_value = self.ramp_duty
+            self.last_pwm_value = None
+        self._apply_speed(print_time, 0., ramp=False)
 
     def get_status(self, eventtime):
         tachometer_status = self.tachometer.get_status(eventtime)
+        rpm_control = self.rpm_control
         return {
             'speed': self.last_fan_value,
             'rpm': tachometer_status['rpm'],
+            'raw_rpm': tachometer_status['raw_rpm'],
+            'target_rpm': (rpm_control.target_rpm
+                           if rpm_control is not None else None),
         }
 
 class FanTachometer:
+    __slots__ = ('printer', 'fan', 'ppr', 'poll_time', '_freq_counter',
+                 'tach_loss_count', 'tach_loss_interval',
+                 'warning_repeat_interval', 'tach_loss_action', 'fan_name',
+                 'tach_loss_time', 'last_warning_time', 'warning_issued',
+                 'check_interval', 'rpm', 'raw_rpm', 'rpm_filter',
+                 'ema_factor', 'outlier_ratio', 'samples', 'sorted_samples',
+                 'sample_index', 'fan_on', 'max_rpm')
     def __init__(self, config, fan):
         self.printer = config.get_printer()
-        self.config = config
         self.fan = fan
         self.ppr = self.poll_time = self._freq_counter = None
         self.tach_loss_count = self.tach_loss_interval = None
-        self.warning_repeat_interval = None
+        self.warning_repeat_interval = self.check_interval = None
+        self.rpm = self.raw_rpm = None
+        self.rpm_filter = self.samples = self.sorted_samples = None
+        self.ema_factor = self.outlier_ratio = 0.
+        self.sample_index = 0
+        self.fan_on = False
+        self.max_rpm = None
         self.tach_loss_action = lambda _: None
         self.initialize_frequency_counter(config)
         self.fan_name = config.get_name().split()[-1]
@@ -152,20 +565,45 @@ class FanTachometer:
                     f" a heater so must have a tach_loss_action of 'shutdown'")
 
     def initialize_frequency_counter(self, config):
-        pin = self.config.get('tachometer_pin', None)
+        pin = config.get('tachometer_pin', None)
         if pin:
-            sample_time = 1.0
-            self.poll_time = self.config.getfloat('tachometer_poll_interval'
-                                                  , 0.0015, above=0.)
-            self.ppr = self.config.getint('tachometer_ppr', 2, minval=1)
+            self.ppr = config.getint('tachometer_ppr', 2, minval=1)
+            self.max_rpm = config.getfloat('max_rpm', 5000., above=0.)
+            # The counter sees 2 * ppr pin changes per revolution and
+            # must poll each level at least TACH_POLLS_PER_EDGE times
+            poll_time = 30. / (self.max_rpm * self.ppr * TACH_POLLS_PER_EDGE)
+            self.poll_time = config.getfloat('tachometer_poll_interval',
+                                             poll_time, above=0.)
+            self.initialize_rpm_filter(config)
             self._freq_counter = pulse_counter.FrequencyCounter(
-                self.printer, pin, sample_time, self.poll_time)
+                self.printer, pin, TACH_SAMPLE_TIME, self.poll_time)
             #Only setup fail options if a valid tach fan
             self.initialize_tach_fail_options(config)
             self.printer.register_event_handler("klippy:connect", self.handle_connect)
+            self.rpm = self.raw_rpm = 0.
+            watchdog = self.printer.lookup_object('fan_tach_watchdog', None)
+            if watchdog is None:
+                watchdog = TachWatchdog(self.printer)
+                self.printer.add_object('fan_tach_watchdog', watchdog)
+            watchdog.add_tachometer(self)
         else:
             self._freq_counter = None
 
+    def initialize_rpm_filter(self, config):
+        filters = {'none': None, 'ema': 'ema', 'median': 'median'}
+        self.rpm_filter = config.getchoice('tachometer_filter', filters,
+                                           default='none')
+        self.ema_factor = config.getfloat('tachometer_ema_factor', 0.3,
+                                          above=0., maxval=1.)
+        self.outlier_ratio = config.getfloat('tachometer_outlier_ratio', 0.,
+                                             minval=0.)
+        window = config.getint('tachometer_filter_window', 5,
+                               minval=1, maxval=15)
+        if self.rpm_filter == 'median' or self.outlier_ratio:
+            # Ring buffer of recent samples and the same samples in order
+            self.samples = array.array('d', [0.] * window)
+            self.sorted_samples = []
+
     def initialize_tach_fail_options(self,config):
         self.tach_loss_interval = (
         config.getfloat('tach_loss_interval',
@@ -174,11 +612,13 @@ class FanTachometer:
                    'none': lambda _: None}
 
         self.tach_loss_action = (
-            self.config.getchoice('tach_loss_action', action,
-                              default='shutdown'))
+            config.getchoice('tach_loss_action', action,
+                             default='shutdown'))
         self.warning_repeat_interval = (
             config.getfloat('tach_warning_repeat_interval', above=-1,
                         default=self.tach_loss_interval))
+        self.check_interval = config.getfloat('tach_check_interval', 0.5,
+                                              above=0., maxval=5.)
 
     def shutdown(self,eventtime):
         self.printer.invoke_shutdown(
@@ -197,21 +637,467 @@ class FanTachometer:
             self.printer.lookup_object('gcode').respond_raw(warning)
             self.last_warning_time = eventtime
 
+    def get_rpm(self):
+        if self._freq_counter is None:
+            return None
+        return self._freq_counter.get_frequency() * 30. / self.ppr
+
+    def _filter_rpm(self, rpm):
+        # Cost per sample is bounded by tachometer_filter_window
+        accept = True
+        samples = self.samples
+        if samples is not None:
+            sorted_samples = self.sorted_samples
+            count = len(sorted_samples)
+            if self.outlier_ratio and count:
+                # Persistent changes are accepted once they reach the
+                # median of the window
+                median = sorted_samples[count // 2]
+                accept = (not median
+                          or abs(rpm - median) <= self.outlier_ratio * median)
+            # Replace the oldest sample in both buffers
+            index = self.sample_index
+            if count == len(samples):
+                old = samples[index]
+                del sorted_samples[bisect.bisect_left(sorted_samples, old)]
+            samples[index] = rpm
+            bisect.insort(sorted_samples, rpm)
+            self.sample_index = (index + 1) % len(samples)
+            if self.rpm_filter == 'median':
+                return sorted_samples[len(sorted_samples) // 2]
+        if not accept:
+            return self.rpm
+        if self.rpm_filter == 'ema' and rpm and self.rpm:
+            return self.rpm + self.ema_factor * (rpm - self.rpm)
+        return rpm
+
+    def _reset_filter(self):
+        # Samples from while the fan was off would hold the filtered rpm
+        # at zero after it starts
+        if self.samples is not None:
+            del self.sorted_samples[:]
+            self.sample_index = 0
+        self.rpm = 0.
+
+    def check(self, eventtime):
+        # Called by TachWatchdog every check_interval
+        fan_on = self.fan.last_fan_value > 0
+        if fan_on != self.fan_on:
+            self.fan_on = fan_on
+            if fan_on:
+                self._reset_filter()
+        raw_rpm = self.raw_rpm = self.get_rpm()
+        rpm = self.rpm = self._filter_rpm(raw_rpm)
+        #Reset the tach loss time if we get a tach signal again
+        if rpm > 0 and self.tach_loss_time:
+            self.tach_loss_time = None
+        if rpm == 0.0 and self.fan.last_fan_value > 0:
+            #Hold the initial time of tach signal loss
+            if not self.tach_loss_time:
+                self.tach_loss_time = eventtime
+            elif eventtime - self.tach_loss_time > self.tach_loss_interval:
+                self.tach_loss_action(eventtime)
+
     def get_status(self, eventtime):
-        if self._freq_counter is not None:
-            rpm = self._freq_counter.get_frequency() * 30. / self.ppr
-            #Reset the tach loss time if we get a tach signal again
-            if rpm > 0 and self.tach_loss_time:
-                self.tach_loss_time = None
-            if rpm == 0.0 and self.fan.last_fan_value > 0:
-                #Hold the initial time of tach signal loss
-                if not self.tach_loss_time:
-                    self.tach_loss_time = eventtime
-                elif eventtime - self.tach_loss_time > self.tach_loss_interval:
-                    self.tach_loss_action(eventtime)
+        # RPM as of the last watchdog check
+        return {'rpm': self.rpm, 'raw_rpm': self.raw_rpm}
+
+# Tach loss detection for all fans with a tachometer, run from a single
+# reactor timer so it does not depend on status queries.  Loss is
+# reported at most tach_loss_interval plus two check intervals after the
+# frequency counter reads zero: one until a check sees the zero, and one
+# more as the loss must last longer than tach_loss_interval from then.
+class TachWatchdog:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.tachometers = []
+        self.check_interval = None
+        self.timer = self.reactor.register_timer(self._check_tachometers)
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+    def add_tachometer(self, tachometer):
+        self.tachometers.append(tachometer)
+        interval = tachometer.check_interval
+        if self.check_interval is None or interval < self.check_interval:
+            self.check_interval = interval
+    def _handle_ready(self):
+        waketime = self.reactor.monotonic() + self.check_interval
+        self.reactor.update_timer(self.timer, waketime)
+    def _check_tachometers(self, eventtime):
+        if self.printer.is_shutdown():
+            return self.reactor.NEVER
+        for tachometer in self.tachometers:
+            tachometer.check(eventtime)
+        return eventtime + self.check_interval
+
+# Closed loop control for SET_FAN_RPM.  A PI loop on a reactor timer
+# adjusts the fan speed to hold target_rpm, with the target as a
+# fraction of max_rpm for the initial speed.  Speeds and errors are
+# fractions of max_rpm so the default gains suit most fans.
+class FanRpmControl:
+    __slots__ = ('printer', 'reactor', 'fan', 'tachometer', 'kp', 'ki',
+                 'interval', 'target_rpm', 'integral', 'timer')
+    def __init__(self, config, fan):
+        self.printer = fan.printer
+        self.reactor = fan.reactor
+        self.fan = fan
+        self.tachometer = fan.tachometer
+        self.kp = config.getfloat('rpm_control_kp', 0.5, minval=0.)
+        self.ki = config.getfloat('rpm_control_ki', 0.5, minval=0.)
+        # The frequency counter reports once per TACH_SAMPLE_TIME
+        self.interval = config.getfloat('rpm_control_interval',
+                                        TACH_SAMPLE_TIME, above=0.)
+        self.target_rpm = None
+        self.integral = 0.
+        # Registered on first use, most fans never run SET_FAN_RPM
+        self.timer = None
+    def start(self, target_rpm):
+        self.target_rpm = target_rpm
+        self.integral = 0.
+        if self.timer is None:
+            self.timer = self.reactor.register_timer(self._update)
+        self.reactor.update_timer(self.timer, self.reactor.NOW)
+    def stop(self):
+        self.target_rpm = None
+        if self.timer is not None:
+            self.reactor.update_timer(self.timer, self.reactor.NEVER)
+    def _update(self, eventtime):
+        if self.printer.is_shutdown():
+            return self.reactor.NEVER
+        # The rpm of the last tach check, after tachometer_filter
+        max_rpm = self.tachometer.max_rpm
+        target = self.target_rpm / max_rpm
+        error = target - self.tachometer.rpm / max_rpm
+        integral = self.integral + self.ki * error * self.interval
+        speed = target + self.kp * error + integral
+        # Stop integrating while the speed is held at a limit
+        if (speed > 1. and error > 0.) or (speed < 0. and error < 0.):
+            integral = self.integral
+            speed = target + self.kp * error + integral
+        self.integral = integral
+        self.fan._set_speed_now(max(0., min(1., speed)))
+        return eventtime + self.interval
+
+# SET_FAN_SPEED for all named fans.  FAN may list several fans, with one
+# SPEED for all of them or one per fan, updated from a single lookahead
+# callback.
+class SetFanSpeedCommand:
+    def __init__(self, printer):
+        self.printer = printer
+        self.fans = {}
+        # FAN parameter -> (fans, lookahead callback for each IMMEDIATE)
+        self.groups = {}
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("SET_FAN_SPEED", self.cmd_SET_FAN_SPEED,
+                               desc=self.cmd_SET_FAN_SPEED_help)
+        gcode.register_command("SET_FAN_RPM", self.cmd_SET_FAN_RPM,
+                               desc=self.cmd_SET_FAN_RPM_help)
+        gcode.register_command("FAN_CALIBRATE", self.cmd_FAN_CALIBRATE,
+                               desc=self.cmd_FAN_CALIBRATE_help)
+    def add_fan(self, name, fan):
+        if name in self.fans:
+            raise self.printer.config_error(
+                "SET_FAN_SPEED FAN=%s is defined by more than one fan"
+                % (name,))
+        self.fans[name] = fan
+    def _make_callback(self, fans):
+        callbacks = tuple(fan.run_queued_command for fan in fans)
+        if not callbacks:
+            return None
+        if len(callbacks) == 1:
+            return callbacks[0]
+        def run_commands(print_time):
+            for callback in callbacks:
+                callback(print_time)
+        return run_commands
+    def _lookup_group(self, gcmd, fan_param):
+        group = self.groups.get(fan_param)
+        if group is not None:
+            return group
+        fans = []
+        for name in fan_param.split(','):
+            fan = self.fans.get(name.strip())
+            if fan is None:
+                raise gcmd.error("The value '%s' is not valid for FAN"
+                                 % (name,))
+            fans.append(fan)
+        callbacks = {
+            None: self._make_callback([f for f in fans if not f.immediate]),
+            0: self._make_callback(fans), 1: None}
+        group = self.groups[fan_param] = (tuple(fans), callbacks)
+        return group
+    def _parse_speeds(self, gcmd, count):
+        speed_param = gcmd.get('SPEED', '0.')
+        speeds = speed_param.split(',')
+        if len(speeds) == 1:
+            speeds = speeds * count
+        elif len(speeds) != count:
+            raise gcmd.error("SPEED must have one value or one per FAN")
+        try:
+            return [float(s) for s in speeds]
+        except ValueError:
+            raise gcmd.error("Unable to parse '%s' as a SPEED"
+                             % (speed_param,))
+    cmd_SET_FAN_SPEED_help = "Sets the speed of one or more fans"
+    def cmd_SET_FAN_SPEED(self, gcmd):
+        fans, callbacks = self._lookup_group(gcmd, gcmd.get('FAN'))
+        params = gcmd.get_command_parameters()
+        if 'AT' in params or 'DURATION' in params:
+            self._set_timed_speeds(gcmd, fans, callbacks)
+            return
+        immediate = gcmd.get_int('IMMEDIATE', None, minval=0, maxval=1)
+        if ',' in params.get('SPEED', ''):
+            self._set_speeds(fans, callbacks, 0.,
+                             self._parse_speeds(gcmd, len(fans)), immediate)
+            return
+        speed = gcmd.get_float('SPEED', 0.)
+        if len(fans) == 1:
+            fans[0].set_speed_from_command(speed, immediate)
+            return
+        self._set_speeds(fans, callbacks, speed, None, immediate)
+    def _set_speeds(self, fans, callbacks, speed, speeds, immediate):
+        for i, fan in enumerate(fans):
+            if speeds is not None:
+                speed = speeds[i]
+            if fan.immediate if immediate is None else immediate:
+                fan.set_speed_immediate(speed)
+            else:
+                fan.queue_speed(speed)
+        callback = callbacks[immediate]
+        if callback is not None:
+            fans[0].toolhead.register_lookahead_callback(callback)
+    def _set_timed_speeds(self, gcmd, fans, callbacks):
+        # AT and DURATION are seconds from now - once started, timed
+        # changes do not wait for queued moves.  Without AT, DURATION
+        # counts from when the speed is applied.
+        delay = gcmd.get_float('AT', 0., minval=0.)
+        duration = gcmd.get_float('DURATION', None, above=0.)
+        immediate = gcmd.get_int('IMMEDIATE', None, minval=0, maxval=1)
+        speeds = self._parse_speeds(gcmd, len(fans))
+        if delay:
+            for fan, speed in zip(fans, speeds):
+                fan.cancel_schedule()
+                fan.schedule_speed(delay, speed)
         else:
-            rpm = None
-        return {'rpm': rpm}
+            self._set_speeds(fans, callbacks, 0., speeds, immediate)
+        if duration is None:
+            return
+        queued = []
+        for fan in fans:
+            if delay or (fan.immediate if immediate is None else immediate):
+                # Switch off once the duration has passed
+                fan.schedule_speed(delay + duration, 0.)
+            else:
+                # The speed waits for queued moves - hold a pending timed
+                # change so a newer command can still cancel the switch off
+                fan.scheduled += 1
+                queued.append((fan, fan.schedule_gen))
+        if queued:
+            fans[0].toolhead.register_lookahead_callback(
+                lambda print_time: self._schedule_off(queued, print_time,
+                                                      duration))
+    def _schedule_off(self, queued, print_time, duration):
+        # Switch off duration seconds after the queued speed's print_time
+        for fan, gen in queued:
+            if gen != fan.schedule_gen:
+                # Replaced by a newer command
+                continue
+            fan.scheduled -= 1
+            curtime = fan.reactor.monotonic()
+            est_print_time = fan.get_mcu().estimated_print_time(curtime)
+            fan.schedule_speed(max(0., print_time + duration - est_print_time
+                                   - IMMEDIATE_TIME), 0.)
+
+    cmd_SET_FAN_RPM_help = "Holds one or more fans at a target RPM"
+    def cmd_SET_FAN_RPM(self, gcmd):
+        fans, callbacks = self._lookup_group(gcmd, gcmd.get('FAN'))
+        rpm = gcmd.get_float('RPM', minval=0.)
+        for fan in fans:
+            if fan.rpm_control is None:
+                raise gcmd.error("SET_FAN_RPM needs a tachometer_pin on"
+                                 " fan '%s'" % (fan.fan_name[1],))
+            if fan.fan_name[0] not in COMMANDED_FAN_TYPES:
+                raise gcmd.error("SET_FAN_RPM can not be used on [%s], it"
+                                 " sets its own speed"
+                                 % (' '.join(fan.fan_name),))
+            max_rpm = fan.tachometer.max_rpm
+            if rpm > max_rpm:
+                raise gcmd.error("RPM %.0f exceeds max_rpm %.0f of fan '%s'"
+                                 % (rpm, max_rpm, fan.fan_name[1]))
+        # Starts right away, like a timed change
+        for fan in fans:
+            fan.set_rpm(rpm)
+
+    cmd_FAN_CALIBRATE_help = "Measures fan RPM over its duty range"
+    def cmd_FAN_CALIBRATE(self, gcmd):
+        name = gcmd.get('FAN')
+        fan = self.fans.get(name)
+        if fan is None:
+            raise gcmd.error("The value '%s' is not valid for FAN" % (name,))
+        if fan.rpm_control is None:
+            raise gcmd.error("FAN_CALIBRATE needs a tachometer_pin on fan '%s'"
+                             % (name,))
+        if fan.fan_name[0] not in COMMANDED_FAN_TYPES:
+            # Its controller would override the sweep, and it may be
+            # cooling something that must not go without air
+            raise gcmd.error("FAN_CALIBRATE can not be used on [%s], it"
+                             " sets its own speed" % (' '.join(fan.fan_name),))
+        steps = gcmd.get_int('STEPS', 10, minval=2, maxval=100)
+        settle_time = gcmd.get_float('SETTLE_TIME', 3., minval=1.)
+        fan.toolhead.wait_moves()
+        speed = fan.last_fan_value
+        if fan.pending_speed is not None:
+            speed = fan.pending_speed
+        fan.cancel_schedule()
+        # Speeds held back by update batching would override the sweep
+        fan.pending_speed = fan.held_speed = None
+        if fan.update_timer is not None:
+            fan.reactor.update_timer(fan.update_timer, fan.reactor.NEVER)
+        calibration = FanCalibration(fan, steps, settle_time)
+        try:
+            samples, start_duty = calibration.run()
+        finally:
+            if not self.printer.is_shutdown():
+                fan.set_duty_now(0.)
+                fan.set_speed_immediate(speed)
+        curve = build_rpm_curve(samples, steps)
+        if curve is None or start_duty is None:
+            raise gcmd.error("No RPM measured on fan '%s'" % (name,))
+        stall_duty, full_rpm, duties = curve
+        start_duty = max(start_duty, stall_duty)
+        # Store duties as fractions of max_power, which scales fan_curve
+        max_power = fan.max_power
+        rpm_curve = tuple(round(min(1., d / max_power), 4) for d in duties)
+        start = round(min(1., start_duty / max_power), 4)
+        # Apply now, the same as loading the saved options at startup
+        fan.fan_curve = compile_fan_curve(_rpm_curve_points(rpm_curve),
+                                          fan.pwm_fan, max_power)
+        fan.kick_below = start * max_power
+        rpm_curve = ", ".join("%.4f" % (d,) for d in rpm_curve)
+        start = "%.4f" % (start,)
+        configfile = self.printer.lookup_object('configfile')
+        section = ' '.join(fan.fan_name)
+        configfile.set(section, 'rpm_curve', rpm_curve)
+        configfile.set(section, 'start_duty', start)
+        msg = ("Fan %s: %.0f RPM at full power, stalls below duty %.3f and"
+               " starts from duty %.3f\nrpm_curve: %s\nstart_duty: %s"
+               % (name, full_rpm, stall_duty, start_duty, rpm_curve, start))
+        if full_rpm > fan.tachometer.max_rpm:
+            msg += "\nmax_rpm should be raised to at least %.0f" % (full_rpm,)
+        msg += ("\nThe SAVE_CONFIG command will update the printer config"
+                " file with these parameters and restart the printer.")
+        gcmd.respond_info(msg)
+
+# Monotone linearization of a FAN_CALIBRATE sweep.  samples are (duty,
+# rpm) pairs in increasing duty.  Returns the stall duty, the full speed
+# rpm and the duties for 1/steps .. steps/steps of that rpm, or None if
+# the fan never turned.
+def build_rpm_curve(samples, steps):
+    curve = []
+    top = 0.
+    for duty, rpm in samples:
+        if rpm > 0.:
+            # Measurement noise must not make the rpm fall with duty
+            top = max(top, rpm)
+            curve.append((duty, top))
+    if not curve:
+        return None
+    stall_duty = curve[0][0]
+    duties = []
+    for i in range(1, steps + 1):
+        target = top * i / steps
+        duty = stall_duty
+        for j, (d, rpm) in enumerate(curve):
+            if rpm >= target:
+                if j:
+                    d0, rpm0 = curve[j - 1]
+                    duty = d0 + (d - d0) * (target - rpm0) / (rpm - rpm0)
+                break
+        duties.append(duty)
+    return stall_duty, top, duties
+
+# FAN_CALIBRATE sweep of one fan.  The duty is stepped down from full
+# power, recording the settled RPM at each step, then up from a stop to
+# the first duty that starts the fan without a kick.
+class FanCalibration:
+    def __init__(self, fan, steps, settle_time):
+        self.printer = fan.printer
+        self.reactor = fan.reactor
+        self.fan = fan
+        self.settle_time = settle_time
+        self.duties = [fan.max_power * i / steps for i in range(steps + 1)]
+        self.stop_rpm = 0.
+    def _pause(self, delay):
+        self.reactor.pause(self.reactor.monotonic() + delay)
+        if self.printer.is_shutdown():
+            raise self.printer.command_error("FAN_CALIBRATE stopped by"
+                                             " a printer shutdown")
+        return self.fan.tachometer.get_rpm()
+    def _measure(self, duty):
+        # Wait at least settle_time, then until the next frequency
+        # sample differs by less than CALIBRATE_SETTLE_RPM.  A rotor
+        # coasting down slowly passes that test, so readings below
+        # CALIBRATE_STOP_RPM of the full speed rpm count as stopped.
+        self.fan.set_duty_now(duty)
+        rpm = self._pause(self.settle_time)
+        max_change = CALIBRATE_SETTLE_RPM * self.fan.tachometer.max_rpm
+        for i in range(CALIBRATE_MAX_SAMPLES):
+            last_rpm = rpm
+            rpm = self._pause(TACH_SAMPLE_TIME)
+            if abs(rpm - last_rpm) <= max_change:
+                break
+        if rpm < self.stop_rpm:
+            return 0.
+        return rpm
+    def run(self):
+        # Reach full speed from any starting state first
+        self.stop_rpm = (CALIBRATE_STOP_RPM
+                         * self._measure(self.duties[-1]))
+        samples = [(duty, self._measure(duty))
+                   for duty in reversed(self.duties)]
+        samples.reverse()
+        for i in range(10):
+            if not self._measure(0.):
+                break
+        else:
+            raise self.printer.command_error("Fan did not stop during"
+                                             " FAN_CALIBRATE")
+        start_duty = None
+        for duty in self.duties[1:]:
+            if self._measure(duty):
+                start_duty = duty
+                break
+        return samples, start_duty
+
+# Timed fan speed changes of all fans, kept in a heap and run from a
+# single reactor timer
+class FanSchedule:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.timer = self.reactor.register_timer(self._run_schedule)
+        self.entries = []
+        self.seq = 0
+    def add(self, waketime, fan, value):
+        # seq keeps entries with equal waketimes in the order added
+        self.seq += 1
+        heapq.heappush(self.entries, (waketime, self.seq, fan,
+                                      fan.schedule_gen, value))
+        if self.entries[0][1] == self.seq:
+            self.reactor.update_timer(self.timer, waketime)
+    def _run_schedule(self, eventtime):
+        entries = self.entries
+        while entries and entries[0][0] <= eventtime:
+            waketime, seq, fan, gen, value = heapq.heappop(entries)
+            if gen != fan.schedule_gen:
+                # Replaced by a newer command
+                continue
+            fan.scheduled -= 1
+            fan._set_speed_now(value)
+        if entries:
+            return entries[0][0]
+        return self.reactor.NEVER
 
 class PrinterFan:
     def __init__(self, config):
@@ -224,7 +1110,7 @@ class PrinterFan:
 
         if not "M106" in self.gcode.ready_gcode_handlers:
             self.gcode.register_command("M106", self.cmd_M106)
-        if not "M106" in self.gcode.ready_gcode_handlers:
+        if not "M107" in self.gcode.ready_gcode_handlers:
             self.gcode.register_command("M107", self.cmd_M107)
     def get_status(self, eventtime):
         return self.fan.get_status(eventtime)
@@ -234,27 +1120,25 @@ class PrinterFan:
 
         fan_number = gcmd.get_int('T', default=0)
 
-        if fan_number not in self.fan_list.keys():
+        fan = self.fan_list.get(fan_number)
+        if fan is None:
             self.gcode.respond_raw(f"!! T{fan_number} is an invalid fan number")
-        else:
-            fan = self.fan_list[fan_number]
-            #Future proofs against Slicer changes to 0 -> 1 fan speed
-            #Currently accepted in RepRap Standard
-            if 0 < value < 1:
-                fan.set_speed_from_command(value)
+            return
+        #Future proofs against Slicer changes to 0 -> 1 fan speed
+        #Currently accepted in RepRap Standard
+        if not 0 < value < 1:
             #Traditional M106 command with speed from 0 -> 255
-            else:
-                value = gcmd.get_float('S', 255., minval=0.) / 255.
-            fan.set_speed_from_command(value)
+            value /= 255.
+        fan.set_speed_from_command(value)
     def cmd_M107(self, gcmd):
         # Turn fan off
         fan_number = gcmd.get_int('T', default=0)
 
-        if fan_number not in self.fan_list.keys():
+        fan = self.fan_list.get(fan_number)
+        if fan is None:
             self.gcode.respond_raw(f"!! T{fan_number} is an invalid fan number")
-        else:
-            fan = self.fan_list[fan_number]
-            fan.set_speed_from_command(0.)
+            return
+        fan.set_speed_from_command(0.)
 
     def add_fan(self, fan_number, Fan):
         if fan_number in self.fan_list.keys():
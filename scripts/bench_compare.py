@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# Run the fan benchmark suite and compare it against a recorded baseline
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, gc, json, platform, time, subprocess, shutil
+import tempfile
+import klippy_mock, bench_fan, bench_scaling, sim_thermal
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'bench_baseline.json')
+
+# All results are microseconds per operation - lower is better
+def bench_m106(count):
+    res = bench_fan.run_benchmark('m106', count, fans=2, enable_pin=True)
+    return res['elapsed'] * 1000000. / count
+
+def bench_set_speed(count):
+    res = bench_fan.run_benchmark('set_speed', count, fans=1, enable_pin=True)
+    return res['elapsed'] * 1000000. / count
+
+def bench_status_sweep(count):
+    sweeps = max(1, count // 32)
+    res = bench_scaling.run_scaling('fan_generic', 32, True, sweeps)
+    return res['sweep_per_fan'] * 1000000.
+
+def bench_controller(control, count):
+    printer = klippy_mock.setup_printer(sim_thermal.build_config(control))
+    tfan = printer.lookup_object('temperature_fan sim')
+    callback = tfan.temperature_callback
+    report_time = klippy_mock.REPORT_TIME
+    temps = [30. + i * .5 for i in range(40)]
+    temps += temps[::-1]
+    ntemps = len(temps)
+    start = time.perf_counter()
+    for i in range(count):
+        callback(i * report_time, temps[i % ntemps])
+    return (time.perf_counter() - start) * 1000000. / count
+
+def bench_tach_check(count):
+    printer = klippy_mock.setup_printer(
+        "[fan]\npin: PA0\ntachometer_pin: PC0\ntach_loss_action: warning\n")
+    fan = printer.lookup_object('fan').fan
+    printer.freq_counters['PC0'].set_rpm(3000.)
+    fan.set_speed(0., 1.)
+    check = fan.tachometer.check
+    start = time.perf_counter()
+    for i in range(count):
+        check(i * .25)
+    return (time.perf_counter() - start) * 1000000. / count
+
+BENCHMARKS = [
+    ('m106_cmd_us', bench_m106),
+    ('set_speed_us', bench_set_speed),
+    ('status_sweep_per_fan_us', bench_status_sweep),
+    ('tach_check_us', bench_tach_check),
+] + [('callback_%s_us' % (c,), lambda n, c=c: bench_controller(c, n))
+     for c in sorted(sim_thermal.CONTROLLERS)]
+
+def host_info():
+    return {'machine': platform.machine(), 'python': platform.python_version(),
+            'implementation': platform.python_implementation()}
+
+# Fixed pure Python workload timed around every benchmark run.  Host
+# speed drifts by tens of percent between runs on shared machines, so
+# benchmarks are compared as multiples of this reference.
+def reference_loop(count):
+    values = {}
+    start = time.perf_counter()
+    for i in range(count):
+        values[i & 63] = i * .5
+    return (time.perf_counter() - start) * 1000000. / count
+
+def run_suite(count, repeat):
+    # Best of several runs (with the collector paused, as timeit does)
+    # filters scheduler and gc noise.  Each round runs every benchmark
+    # once, so a slow period of the host affects all of them alike, and
+    # a warm-up round is discarded.
+    times = {name: [] for name, func in BENCHMARKS}
+    relative = {name: [] for name, func in BENCHMARKS}
+    gc.disable()
+    try:
+        for name, func in BENCHMARKS:
+            func(count)
+        for i in range(repeat):
+            for name, func in BENCHMARKS:
+                before = reference_loop(count)
+                elapsed = func(count)
+                after = reference_loop(count)
+                times[name].append(elapsed)
+                relative[name].append(elapsed / min(before, after))
+    finally:
+        gc.enable()
+    return ({name: min(t) for name, t in times.items()},
+            {name: min(r) for name, r in relative.items()})
+
+def record_suite(count, repeat, runs):
+    # Spread of the best relative times of independent suite runs is the
+    # noise floor of each benchmark
+    suites = [run_suite(count, repeat) for i in range(runs)]
+    results = {}
+    relative = {}
+    noise = {}
+    for name in suites[0][0]:
+        results[name] = min(s[0][name] for s in suites)
+        values = [s[1][name] for s in suites]
+        relative[name] = min(values)
+        noise[name] = (max(values) - min(values)) / min(values)
+    return {'results': results, 'relative': relative, 'noise': noise}
+
+# Copy the fan modules of a git revision to a temporary directory
+def checkout_revision(rev):
+    srcdir = tempfile.mkdtemp(prefix='bench_compare-')
+    try:
+        for name in klippy_mock.EXTRAS:
+            source = subprocess.check_output(
+                ['git', '-C', klippy_mock.SRCDIR, 'show',
+                 '%s:./%s.py' % (rev, name)], stderr=subprocess.DEVNULL)
+            with open(os.path.join(srcdir, name + '.py'), 'wb') as f:
+                f.write(source)
+    except:
+        shutil.rmtree(srcdir)
+        raise
+    return srcdir
+
+def run_ab_suite(package, count, repeat):
+    # Each benchmark runs on both sources back to back, alternating
+    # which goes first, so drift of the host affects both alike and the
+    # best times are compared directly.  The first round is a warm-up.
+    sources = [package, 'extras']
+    times = {p: {name: [] for name, func in BENCHMARKS} for p in sources}
+    order = list(sources)
+    gc.disable()
+    try:
+        for i in range(repeat + 1):
+            for name, func in BENCHMARKS:
+                for p in order:
+                    klippy_mock.use_source(p)
+                    times[p][name].append(func(count))
+                order.reverse()
+    finally:
+        gc.enable()
+        klippy_mock.use_source('extras')
+    return [{name: min(t[1:]) for name, t in times[p].items()}
+            for p in sources]
+
+def compare(baseline, data, tolerance):
+    # A benchmark regresses when its time relative to reference_loop is
+    # slower than the tolerance plus the noise measured when the
+    # baseline was recorded.  Results without relative times are
+    # compared in microseconds.
+    regressions = []
+    noise = baseline.get('noise', {})
+    base_relative = baseline.get('relative', {})
+    cur_relative = data.get('relative', {})
+    print("%-34s %10s %10s %8s %8s" % ("benchmark", "baseline", "current",
+                                       "change", "allowed"))
+    for name, base in sorted(baseline['results'].items()):
+        cur = data['results'].get(name)
+        if cur is None:
+            print("%-34s %10.3f %10s" % (name, base, "missing"))
+            continue
+        if name in base_relative and name in cur_relative:
+            change = cur_relative[name] / base_relative[name] - 1.
+        else:
+            change = (cur - base) / base
+        allowed = tolerance + noise.get(name, 0.)
+        flag = ""
+        if change > allowed:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print("%-34s %10.3f %10.3f %+7.1f%% %7.1f%%%s" % (
+            name, base, cur, change * 100., allowed * 100., flag))
+    return regressions
+
+def compare_revision(rev, count, repeat, tolerance):
+    # Both revisions are timed in this run, so the result does not
+    # depend on a recorded baseline and only the tolerance is allowed
+    try:
+        srcdir = checkout_revision(rev)
+    except subprocess.CalledProcessError:
+        sys.exit("Unable to read the fan modules of revision '%s'" % (rev,))
+    klippy_mock.add_source('extras_base', srcdir)
+    try:
+        base, results = run_ab_suite('extras_base', count, repeat)
+    finally:
+        shutil.rmtree(srcdir)
+    print("Working tree against %s" % (rev,))
+    regressions = compare({'results': base}, {'results': results},
+                          tolerance)
+    if regressions:
+        print("%d benchmark(s) regressed by more than %.0f%% against %s"
+              % (len(regressions), tolerance * 100., rev))
+        sys.exit(1)
+    print("No regressions beyond %.0f%% against %s"
+          % (tolerance * 100., rev))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--baseline", type="string", dest="baseline",
+                    default=BASELINE, help="baseline JSON file")
+    opts.add_option("-r", "--record", action="store_true", dest="record",
+                    help="record the current results as the baseline")
+    opts.add_option("-a", "--against", type="string", dest="against",
+                    help="compare the working tree against the fan modules"
+                    " of a git revision, timed in the same run")
+    opts.add_option("-i", "--input", type="string", dest="input",
+                    help="compare a previously saved results JSON instead"
+                    " of running the suite")
+    opts.add_option("-o", "--output", type="string", dest="output",
+                    help="save the current results to a JSON file")
+    opts.add_option("-t", "--tolerance", type="float", dest="tolerance",
+                    default=.10, help="allowed slowdown fraction (0.10)")
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    help="operations per benchmark run (50000, or 5000"
+                    " with --against)")
+    opts.add_option("--repeat", type="int", dest="repeat",
+                    help="runs per benchmark, the best is kept (9, or 90"
+                    " with --against)")
+    opts.add_option("--record-runs", type="int", dest="record_runs",
+                    default=5, help="suite runs used to measure the noise"
+                    " of each benchmark when recording")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.against:
+        if options.record or options.input or options.output:
+            opts.error("--against can not be combined with --record,"
+                       " --input or --output")
+        # Many short runs alternate the revisions more often, which
+        # cancels more of the host drift than a few long ones
+        compare_revision(options.against, options.count or 5000,
+                         options.repeat or 90, options.tolerance)
+        return
+    count = options.count or 50000
+    repeat = options.repeat or 9
+    if options.input:
+        with open(options.input) as f:
+            data = json.load(f)
+    elif options.record:
+        data = record_suite(count, repeat, max(2, options.record_runs))
+        data['host'] = host_info()
+    else:
+        results, relative = run_suite(count, repeat)
+        data = {'host': host_info(), 'results': results,
+                'relative': relative}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if options.record:
+        with open(options.baseline, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Recorded baseline to %s" % (options.baseline,))
+        return
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('host') != data.get('host'):
+        print("Warning: baseline was recorded on %s, current host is %s"
+              % (baseline.get('host'), data.get('host')))
+    regressions = compare(baseline, data, options.tolerance)
+    if regressions:
+        print("%d benchmark(s) regressed by more than %.0f%% plus their"
+              " recorded noise" % (len(regressions), options.tolerance * 100.))
+        sys.exit(1)
+    print("No regressions beyond %.0f%% plus the recorded noise"
+          % (options.tolerance * 100.,))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Benchmark the host-side cost of fan speed commands
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, time
+import klippy_mock
+
+SPEED_PATTERN = [0, 64, 128, 255, 191, 32, 0, 255]
+
+def build_config(fans=1, enable_pin=False, kick_start_time=0.1):
+    lines = ["[fan]", "pin: PA0", "kick_start_time: %s" % (kick_start_time,)]
+    if enable_pin:
+        lines.append("enable_pin: PB0")
+    for i in range(1, fans):
+        lines += ["", "[fan_generic fan%d]" % (i,), "pin: PA%d" % (i,),
+                  "kick_start_time: %s" % (kick_start_time,)]
+        if enable_pin:
+            lines.append("enable_pin: PB%d" % (i,))
+    return "\n".join(lines) + "\n"
+
+def count_mcu_traffic(printer):
+    pins = printer.lookup_object('pins')
+    pwm = sum(p.set_count for p in pins.get_pins(klippy_mock.MockPWM))
+    digital = sum(p.set_count
+                  for p in pins.get_pins(klippy_mock.MockDigitalOut))
+    return pwm, digital
+
+# Time a list of pre-parsed commands through their gcode handlers
+def time_commands(printer, commands, count):
+    gcode = printer.lookup_object('gcode')
+    gcmds = []
+    for line in commands:
+        cmd, params = gcode.parse_line(line)
+        gcmds.append((gcode.ready_gcode_handlers[cmd],
+                      gcode.create_gcode_command(cmd, line, params)))
+    ncmds = len(gcmds)
+    start = time.perf_counter()
+    for i in range(count):
+        handler, gcmd = gcmds[i % ncmds]
+        handler(gcmd)
+    return time.perf_counter() - start
+
+def run_m106(printer, count):
+    cmds = ["M106 S%d" % (s,) if s else "M107" for s in SPEED_PATTERN]
+    return time_commands(printer, cmds, count)
+
+def run_set_fan_speed(printer, count):
+    names = [n.split()[1] for n, o in printer.lookup_objects('fan_generic')]
+    cmds = ["SET_FAN_SPEED FAN=%s SPEED=%.3f" % (name, s / 255.)
+            for s in SPEED_PATTERN for name in names]
+    return time_commands(printer, cmds, count)
+
+def run_set_fan_speed_group(printer, count):
+    names = [n.split()[1] for n, o in printer.lookup_objects('fan_generic')]
+    cmds = ["SET_FAN_SPEED FAN=%s SPEED=%.3f" % (",".join(names), s / 255.)
+            for s in SPEED_PATTERN]
+    return time_commands(printer, cmds, count)
+
+def run_set_speed(printer, count):
+    fan = printer.lookup_object('fan').fan
+    values = [s / 255. for s in SPEED_PATTERN]
+    nvalues = len(values)
+    toolhead = printer.lookup_object('toolhead')
+    print_time = toolhead.get_last_move_time()
+    start = time.perf_counter()
+    for i in range(count):
+        fan.set_speed(print_time, values[i % nvalues])
+    return time.perf_counter() - start
+
+MODES = {'m106': run_m106, 'set_fan_speed': run_set_fan_speed,
+         'set_fan_speed_group': run_set_fan_speed_group,
+         'set_speed': run_set_speed}
+
+def run_benchmark(mode, count, fans=1, enable_pin=False, kick_start_time=0.1,
+                  lookahead_time=0.):
+    printer = klippy_mock.setup_printer(
+        build_config(fans, enable_pin, kick_start_time), lookahead_time)
+    toolhead = printer.lookup_object('toolhead')
+    # Memory blocks still held per command - with a lookahead time the
+    # queued callbacks (and anything they reference) stay allocated
+    blocks = sys.getallocatedblocks()
+    elapsed = MODES[mode](printer, count)
+    blocks = sys.getallocatedblocks() - blocks
+    toolhead.flush_lookahead()
+    pwm, digital = count_mcu_traffic(printer)
+    return {'mode': mode, 'commands': count, 'elapsed': elapsed,
+            'rate': count / elapsed, 'set_pwm': pwm, 'set_digital': digital,
+            'callbacks': toolhead.callback_count,
+            'blocks_per_command': blocks / count}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-m", "--mode", type="choice", dest="mode",
+                    choices=sorted(MODES), default="m106",
+                    help="command path to benchmark (m106, set_fan_speed,"
+                    " set_fan_speed_group, set_speed)")
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=200000, help="number of commands to issue")
+    opts.add_option("-f", "--fans", type="int", dest="fans", default=2,
+                    help="number of fans to configure")
+    opts.add_option("-e", "--enable-pin", action="store_true",
+                    dest="enable_pin", help="configure fan enable pins")
+    opts.add_option("-k", "--kick-start-time", type="float",
+                    dest="kick_start_time", default=0.1,
+                    help="kick_start_time for each fan")
+    opts.add_option("-l", "--lookahead-time", type="float",
+                    dest="lookahead_time", default=0.,
+                    help="queue commands instead of running their"
+                    " callbacks at once")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.mode.startswith('set_fan_speed') and options.fans < 2:
+        opts.error("%s mode requires at least 2 fans" % (options.mode,))
+    res = run_benchmark(options.mode, options.count, options.fans,
+                        options.enable_pin, options.kick_start_time,
+                        options.lookahead_time)
+    print("mode=%s commands=%d elapsed=%.3fs" % (
+        res['mode'], res['commands'], res['elapsed']))
+    print("commands/s=%.0f usec/command=%.2f" % (
+        res['rate'], 1000000. / res['rate']))
+    print("lookahead_callbacks=%d set_pwm=%d set_digital=%d" % (
+        res['callbacks'], res['set_pwm'], res['set_digital']))
+    print("allocated_blocks/command=%.2f" % (res['blocks_per_command'],))
+
+if __name__ == '__main__':
+    main()
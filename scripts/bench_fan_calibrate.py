@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Run FAN_CALIBRATE on a simulated fan and measure the speed linearity
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, time
+import klippy_mock, bench_fan_rpm
+
+CONFIG = """
+[fan_generic blower]
+pin: PA0
+tachometer_pin: PC0
+tach_loss_action: none
+max_rpm: 4000
+"""
+
+SPEEDS = [.05, .1, .2, .3, .4, .5, .6, .7, .8, .9, 1.]
+
+def setup(config_text, plant_args):
+    printer = klippy_mock.setup_printer(config_text)
+    fan = printer.lookup_object('fan_generic blower').fan
+    plant = klippy_mock.MockFanPlant(printer, fan.mcu_fan,
+                                     printer.freq_counters['PC0'],
+                                     **plant_args)
+    return printer, fan, plant
+
+# Settled rpm for each requested speed, each started from a stopped fan
+def measure_speeds(config_text, plant_args, settle_time=8.):
+    printer, fan, plant = setup(config_text, plant_args)
+    reactor = printer.get_reactor()
+    results = []
+    for speed in SPEEDS:
+        fan.set_speed_immediate(0.)
+        reactor.run_until(reactor.monotonic() + settle_time)
+        fan.set_speed_immediate(speed)
+        reactor.run_until(reactor.monotonic() + settle_time)
+        results.append((speed, plant.rpm))
+    return results
+
+def linearity(results, min_speed):
+    # Worst distance from a straight line through the full speed rpm
+    full_rpm = results[-1][1]
+    return max(abs(rpm / full_rpm - speed) for speed, rpm in results
+               if speed >= min_speed)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--steps", type="int", dest="steps", default=10,
+                    help="FAN_CALIBRATE STEPS")
+    opts.add_option("-t", "--settle-time", type="float", dest="settle_time",
+                    default=3., help="FAN_CALIBRATE SETTLE_TIME")
+    opts.add_option("--stall-duty", type="float", dest="stall_duty",
+                    default=.2, help="duty below which the fan stalls")
+    opts.add_option("--start-duty", type="float", dest="start_duty",
+                    default=.3, help="duty that starts a stopped fan")
+    opts.add_option("--exponent", type="float", dest="exponent",
+                    default=.6, help="shape of the simulated duty to rpm")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    plant_args = {'stall_duty': options.stall_duty,
+                  'start_duty': options.start_duty,
+                  'exponent': options.exponent}
+    printer, fan, plant = setup(CONFIG, plant_args)
+    reactor = printer.get_reactor()
+    start = time.perf_counter()
+    bench_fan_rpm.run_command(
+        printer, "FAN_CALIBRATE FAN=blower STEPS=%d SETTLE_TIME=%s"
+        % (options.steps, options.settle_time))
+    elapsed = time.perf_counter() - start
+    print("\n".join(printer.lookup_object('gcode').responses))
+    print("sweep took %.0fs of printer time (%.2fs host time)"
+          % (reactor.monotonic(), elapsed))
+    saved = printer.lookup_object('configfile').get_autosave_text()
+    before = measure_speeds(CONFIG, plant_args)
+    after = measure_speeds(CONFIG + saved, plant_args)
+    print("%6s %12s %12s" % ("speed", "rpm_before", "rpm_after"))
+    for (speed, rpm_before), (_, rpm_after) in zip(before, after):
+        print("%6.2f %12.0f %12.0f" % (speed, rpm_before, rpm_after))
+    # Speeds below the stall rpm can not be linear
+    min_speed = min(s for s, rpm in after if s * after[-1][1] >= after[0][1])
+    print("worst deviation from linear rpm from speed %.2f: before %.1f%%"
+          " after %.1f%%" % (min_speed, linearity(before, min_speed) * 100.,
+                             linearity(after, min_speed) * 100.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Compare SET_FAN_RPM closed loop control against a fixed SET_FAN_SPEED
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse
+import klippy_mock
+
+RATED_RPM = 3000.
+STALL_DUTY = .15
+PLANT_TAU = 1.5
+PLANT_STEP = .05
+RUN_TIME = 120.
+SETTLE_BAND = .02
+
+CONFIG = """
+[fan_generic blower]
+pin: PA0
+tachometer_pin: PC0
+tach_loss_action: none
+max_rpm: %s
+""" % (RATED_RPM,)
+
+# name: health of the fan over time (1.0 is the reference fan)
+SCENARIOS = {
+    'nominal': lambda t: 1.,
+    'aged': lambda t: .85,
+    'voltage_sag': lambda t: .88 if t >= 60. else 1.,
+    'clogged_filter': lambda t: max(.75, 1. - t / 400.),
+}
+
+def plant_rpm(duty, health):
+    if duty <= STALL_DUTY:
+        return 0.
+    return RATED_RPM * health * ((duty - STALL_DUTY)
+                                 / (1. - STALL_DUTY)) ** .7
+
+# SET_FAN_SPEED value that gives rpm on the reference fan
+def open_loop_speed(rpm):
+    duty = STALL_DUTY + (1. - STALL_DUTY) * (rpm / RATED_RPM) ** (1. / .7)
+    # Invert the default 0.2 + 0.8 * speed curve of a non 4 wire fan
+    return max(0., (duty - .2) / .8)
+
+def run_command(printer, line):
+    gcode = printer.lookup_object('gcode')
+    cmd, params = gcode.parse_line(line)
+    gcode.ready_gcode_handlers[cmd](
+        gcode.create_gcode_command(cmd, line, params))
+
+def run_scenario(name, target_rpm, closed_loop):
+    health = SCENARIOS[name]
+    printer = klippy_mock.setup_printer(CONFIG)
+    reactor = printer.get_reactor()
+    fan = printer.lookup_object('fan_generic blower').fan
+    counter = printer.freq_counters['PC0']
+    updates = []
+    fan.mcu_fan.listener = lambda print_time, value: updates.append(
+        (print_time, value))
+    if closed_loop:
+        run_command(printer, "SET_FAN_RPM FAN=blower RPM=%.0f"
+                    % (target_rpm,))
+    else:
+        run_command(printer, "SET_FAN_SPEED FAN=blower SPEED=%.4f IMMEDIATE=1"
+                    % (open_loop_speed(target_rpm),))
+    duty = rpm = sample_sum = 0.
+    samples = 0
+    next_update = 0
+    errors = []
+    settle_time = None
+    eventtime = reactor.monotonic()
+    while eventtime < RUN_TIME:
+        eventtime += PLANT_STEP
+        reactor.run_until(eventtime)
+        while next_update < len(updates) and (
+                updates[next_update][0] <= eventtime):
+            duty = updates[next_update][1]
+            next_update += 1
+        target = plant_rpm(duty, health(eventtime))
+        rpm += (target - rpm) * PLANT_STEP / PLANT_TAU
+        # The frequency counter reports the mean over each second
+        sample_sum += rpm
+        samples += 1
+        if samples * PLANT_STEP >= .999:
+            counter.set_rpm(sample_sum / samples)
+            sample_sum = 0.
+            samples = 0
+        error = abs(rpm - target_rpm) / target_rpm
+        errors.append((eventtime, error))
+        if error > SETTLE_BAND:
+            settle_time = None
+        elif settle_time is None:
+            settle_time = eventtime
+    # Steady state error over the last quarter of the run
+    tail = [e for t, e in errors if t >= RUN_TIME * .75]
+    return {'steady_error': sum(tail) / len(tail),
+            'worst_error': max(tail), 'settle_time': settle_time,
+            'updates_per_min': len(updates) * 60. / RUN_TIME}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--rpm", type="float", dest="rpm", default=1800.,
+                    help="target fan rpm")
+    opts.add_option("-s", "--scenario", type="choice", dest="scenario",
+                    choices=sorted(SCENARIOS) + ['all'], default='all',
+                    help="fan condition to simulate")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    scenarios = sorted(SCENARIOS)
+    if options.scenario != 'all':
+        scenarios = [options.scenario]
+    print("%-15s %-14s %10s %9s %9s %13s" % (
+        "scenario", "mode", "steady_err", "worst", "settle_s", "updates/min"))
+    for name in scenarios:
+        for closed_loop in (False, True):
+            res = run_scenario(name, options.rpm, closed_loop)
+            settle = "-"
+            if res['settle_time'] is not None:
+                settle = "%.1f" % (res['settle_time'],)
+            print("%-15s %-14s %9.1f%% %8.1f%% %9s %13.1f" % (
+                name, "SET_FAN_RPM" if closed_loop else "SET_FAN_SPEED",
+                res['steady_error'] * 100., res['worst_error'] * 100.,
+                settle, res['updates_per_min']))
+
+if __name__ == '__main__':
+    main()
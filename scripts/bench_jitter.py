@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Measure how long temperature_callback holds the reactor per sensor report
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, math, random, time
+import klippy_mock, sim_thermal
+
+def build_config(control, fans):
+    sections = []
+    for i in range(fans):
+        section = sim_thermal.build_config(control)
+        sections.append(section.replace("[temperature_fan sim]",
+                                        "[temperature_fan tf%d]" % (i,), 1)
+                        .replace("pin: PA0", "pin: P%d" % (i,), 1))
+    return "\n".join(sections)
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.))
+    return sorted_values[idx]
+
+# Sorted callback durations in nanoseconds for every report of every fan
+# and the summed duration of all callbacks in each report period
+def run_jitter(control, fans, seconds, seed=0):
+    printer = klippy_mock.setup_printer(build_config(control, fans))
+    callbacks = [printer.lookup_object('temperature_fan tf%d' % (i,))
+                 .temperature_callback for i in range(fans)]
+    report_time = klippy_mock.REPORT_TIME
+    rng = random.Random(seed)
+    phases = [rng.uniform(0., 2. * math.pi) for i in range(fans)]
+    perf_counter_ns = time.perf_counter_ns
+    durations = []
+    tick_totals = []
+    ticks = int(seconds / report_time)
+    for tick in range(ticks):
+        read_time = tick * report_time
+        tick_start = len(durations)
+        for callback, phase in zip(callbacks, phases):
+            temp = (40. + 15. * math.sin(read_time / 60. + phase)
+                    + rng.gauss(0., .3))
+            start = perf_counter_ns()
+            callback(read_time, temp)
+            durations.append(perf_counter_ns() - start)
+        tick_totals.append(sum(durations[tick_start:]))
+    durations.sort()
+    return durations, tick_totals
+
+def histogram(durations, width=40):
+    # Power of two buckets in microseconds
+    buckets = {}
+    for d in durations:
+        us = d / 1000.
+        bucket = 0 if us < 1. else int(math.log2(us)) + 1
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    peak = max(buckets.values())
+    lines = []
+    for bucket in range(max(buckets) + 1):
+        count = buckets.get(bucket, 0)
+        low = 0 if not bucket else 2 ** (bucket - 1)
+        bar = '#' * int(math.ceil(count * width / peak)) if count else ''
+        lines.append("  %6d-%-6d us %9d %s" % (low, 2 ** bucket, count, bar))
+    return "\n".join(lines)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--control", type="choice", dest="control",
+                    choices=sorted(sim_thermal.CONTROLLERS) + ['all'],
+                    default='all', help="controller to measure (or 'all')")
+    opts.add_option("-f", "--fans", type="int", dest="fans", default=32,
+                    help="number of temperature fans")
+    opts.add_option("-s", "--seconds", type="float", dest="seconds",
+                    default=600., help="simulated seconds of sensor reports")
+    opts.add_option("-t", "--threshold", type="float", dest="threshold",
+                    default=50., help="p99 limit in microseconds")
+    opts.add_option("-m", "--max-threshold", type="float",
+                    dest="max_threshold", default=0.,
+                    help="optional limit on the worst callback (usec)")
+    opts.add_option("--histogram", action="store_true", dest="histogram",
+                    help="print a latency histogram per controller")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    controls = sorted(sim_thermal.CONTROLLERS)
+    if options.control != 'all':
+        controls = [options.control]
+    failed = []
+    print("%-18s %9s %8s %8s %8s %8s %9s %s" % (
+        "control", "callbacks", "p50_us", "p99_us", "p999_us", "max_us",
+        "period_us", "result"))
+    for control in controls:
+        durations, tick_totals = run_jitter(control, options.fans,
+                                            options.seconds)
+        p50 = percentile(durations, 50.) / 1000.
+        p99 = percentile(durations, 99.) / 1000.
+        p999 = percentile(durations, 99.9) / 1000.
+        worst = durations[-1] / 1000.
+        ok = p99 <= options.threshold
+        if options.max_threshold and worst > options.max_threshold:
+            ok = False
+        if not ok:
+            failed.append(control)
+        # Worst total time all fans spent in one sensor report period
+        period = max(tick_totals) / 1000.
+        print("%-18s %9d %8.2f %8.2f %8.2f %8.2f %9.1f %s" % (
+            control, len(durations), p50, p99, p999, worst, period,
+            "PASS" if ok else "FAIL"))
+        if options.histogram:
+            print(histogram(durations))
+    if failed:
+        print("Failed: %s" % (", ".join(failed),))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Benchmark config load, connect and status cost as the fan count grows
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, configparser, time, tracemalloc
+import klippy_mock
+
+KINDS = ['fan_generic', 'temperature_fan']
+
+def build_config(kind, count, tach=False):
+    lines = ["[fan]", "pin: P0"]
+    for i in range(1, count + 1):
+        lines += ["", "[%s fan%d]" % (kind, i), "pin: P%d" % (i,),
+                  "slicer_fan_number: %d" % (i,)]
+        if kind == 'temperature_fan':
+            lines += ["sensor_type: sim", "min_temp: 0", "max_temp: 100",
+                      "control: watermark"]
+        if tach:
+            lines += ["tachometer_pin: T%d" % (i,),
+                      "tach_loss_action: warning"]
+    return "\n".join(lines) + "\n"
+
+def build_printer(config_text):
+    fileconfig = configparser.RawConfigParser(strict=False)
+    fileconfig.read_string(config_text)
+    printer = klippy_mock.MockPrinter()
+    config = klippy_mock.MockConfig(printer, fileconfig, 'printer')
+    return printer, config, fileconfig.sections()
+
+def measure_memory(kind, count, tach):
+    printer, config, sections = build_printer(build_config(kind, count, tach))
+    tracemalloc.start()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    for section in sections:
+        printer.load_object(config, section)
+    mem_used = tracemalloc.get_traced_memory()[0] - mem_start
+    tracemalloc.stop()
+    return mem_used
+
+def run_scaling(kind, count, tach=False, sweeps=20):
+    klippy_mock.load_extras()
+    # Memory is measured on a separate build so tracing does not skew
+    # the construction time
+    mem_used = measure_memory(kind, count, tach)
+    printer, config, sections = build_printer(build_config(kind, count, tach))
+    start = time.perf_counter()
+    for section in sections:
+        printer.load_object(config, section)
+    construct = time.perf_counter() - start
+    start = time.perf_counter()
+    printer.send_event("klippy:connect")
+    connect = time.perf_counter() - start
+    objs = [obj for name, obj in printer.lookup_objects()
+            if hasattr(obj, 'get_status') and (name == 'fan'
+                                               or name.startswith(kind))]
+    eventtime = 1.
+    start = time.perf_counter()
+    for i in range(sweeps):
+        for obj in objs:
+            obj.get_status(eventtime)
+        eventtime += .25
+    sweep = (time.perf_counter() - start) / sweeps
+    fans = count + 1
+    return {'kind': kind, 'count': count, 'tach': tach,
+            'construct': construct, 'connect': connect,
+            'bytes_per_fan': mem_used / fans, 'sweep': sweep,
+            'sweep_per_fan': sweep / fans}
+
+# Shallow size of an instance including its attribute dict if it has one
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def profile_memory(kind, count, tach):
+    klippy_mock.load_extras()
+    printer, config, sections = build_printer(build_config(kind, count, tach))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for section in sections:
+        printer.load_object(config, section)
+    printer.send_event("klippy:connect")
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    fans = count + 1
+    by_file = {}
+    for stat in after.compare_to(before, 'filename'):
+        name = os.path.basename(stat.traceback[0].filename)
+        by_file[name] = by_file.get(name, 0) + stat.size_diff
+    layouts = {}
+    for name, obj in printer.lookup_objects():
+        if not name.startswith(kind):
+            continue
+        for inst in (obj, obj.fan, obj.fan.tachometer,
+                     getattr(obj, 'control', None)):
+            if inst is None:
+                continue
+            cls = type(inst).__name__
+            layouts.setdefault(cls, []).append(instance_size(inst))
+    return {'total': sum(by_file.values()) / fans,
+            'by_file': {n: b / fans for n, b in by_file.items()},
+            'layouts': {c: sum(v) / len(v) for c, v in layouts.items()}}
+
+def print_memory(kind, count, tach):
+    res = profile_memory(kind, count, tach)
+    print("%s x%d (tach %s): %.0f traced bytes per fan" % (
+        kind, count, "yes" if tach else "no", res['total']))
+    for name, size in sorted(res['by_file'].items(), key=lambda i: -i[1]):
+        if abs(size) >= 1.:
+            print("  %-24s %8.0f bytes/fan" % (name, size))
+    for cls, size in sorted(res['layouts'].items()):
+        print("  %-24s %8.0f bytes/instance (shallow)" % (cls, size))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-m", "--max-fans", type="int", dest="max_fans",
+                    default=256, help="largest fan count (doubling from 1)")
+    opts.add_option("-k", "--kind", type="choice", dest="kind",
+                    choices=KINDS + ['all'], default='all',
+                    help="fan section type to generate")
+    opts.add_option("--memory", action="store_true", dest="memory",
+                    help="profile memory per fan at --max-fans instead")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    kinds = KINDS if options.kind == 'all' else [options.kind]
+    if options.memory:
+        for kind in kinds:
+            for tach in (False, True):
+                print_memory(kind, options.max_fans, tach)
+        return
+    print("%-16s %5s %5s %11s %10s %10s %10s %11s" % (
+        "kind", "fans", "tach", "construct_ms", "connect_ms", "bytes/fan",
+        "sweep_us", "us/fan/poll"))
+    for kind in kinds:
+        for tach in (False, True):
+            count = 1
+            while count <= options.max_fans:
+                res = run_scaling(kind, count, tach)
+                print("%-16s %5d %5s %11.2f %10.3f %10.0f %10.1f %11.2f" % (
+                    kind, count, "yes" if tach else "no",
+                    res['construct'] * 1000., res['connect'] * 1000.,
+                    res['bytes_per_fan'], res['sweep'] * 1000000.,
+                    res['sweep_per_fan'] * 1000000.))
+                count *= 2
+
+if __name__ == '__main__':
+    main()
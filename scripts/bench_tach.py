@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Benchmark FanTachometer loss detection against scripted tach signals
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, time
+import klippy_mock
+
+PPR = 2
+RUN_TIME = 40.
+ONSET = 10.
+
+# name: (trace factory, tach loss expected)
+SCENARIOS = {
+    'steady': (lambda: klippy_mock.RpmTrace(3000., noise=.05), False),
+    'stall': (lambda: klippy_mock.RpmTrace(3000.).stall(ONSET), True),
+    'short_dropout': (lambda: klippy_mock.RpmTrace(3000.).dropout(ONSET, 1.5),
+                      False),
+    'long_dropout': (lambda: klippy_mock.RpmTrace(3000.).dropout(ONSET, 8.),
+                     True),
+    'spin_down': (lambda: klippy_mock.RpmTrace(3000.).spin_down(ONSET, 2.),
+                  True),
+    'low_rpm_noise': (lambda: klippy_mock.RpmTrace(60., noise=.8), False),
+    # Brief signal drops, as from PWM interference, that each empty a
+    # single frequency sample
+    'glitches': (lambda: klippy_mock.RpmTrace(3000.).dropout(ONSET + .3, .6)
+                 .dropout(ONSET + 10.6, .6).dropout(ONSET + 20.1, .6), False),
+    # Fan switched on at ONSET after standing still.  A tach_loss_interval
+    # shorter than the spin-up reports loss with or without a filter.
+    'start_from_stop': (lambda: klippy_mock.RpmTrace(0.)
+                        .set_speed(ONSET + 1., 3000.), False),
+    'fast_start': (lambda: klippy_mock.RpmTrace(0.)
+                   .set_speed(ONSET + .25, 3000.), False),
+}
+
+# Scenarios where the fan is off until the given time
+START_TIMES = {'start_from_stop': ONSET, 'fast_start': ONSET}
+
+def build_config(tach_loss_interval, check_interval, rpm_filter='none',
+                 outlier_ratio=0., window=5):
+    return ("[fan]\npin: PA0\ntachometer_pin: PC0\ntachometer_ppr: %d\n"
+            "tach_loss_action: shutdown\ntach_loss_interval: %s\n"
+            "tach_check_interval: %s\ntachometer_filter: %s\n"
+            "tachometer_outlier_ratio: %s\ntachometer_filter_window: %d\n"
+            % (PPR, tach_loss_interval, check_interval, rpm_filter,
+               outlier_ratio, window))
+
+# Loss is detected by the tach watchdog timer, status is only read
+def run_scenario(name, check_interval, tach_loss_interval=3.,
+                 rpm_filter='none', outlier_ratio=0., window=5):
+    make_trace, expect_loss = SCENARIOS[name]
+    trace = make_trace()
+    printer = klippy_mock.setup_printer(build_config(
+        tach_loss_interval, check_interval, rpm_filter, outlier_ratio,
+        window))
+    reactor = printer.get_reactor()
+    fan = printer.lookup_object('fan').fan
+    counter = printer.freq_counters['PC0']
+    counter.set_trace(trace, PPR)
+    start_time = START_TIMES.get(name, 0.)
+    start = time.perf_counter()
+    reactor.run_until(start_time)
+    fan.set_speed(start_time, 1.)
+    reactor.run_until(RUN_TIME)
+    elapsed = time.perf_counter() - start
+    detect_time = printer.shutdown_time
+    checks = int((detect_time or RUN_TIME) / check_interval)
+    get_status = fan.get_status
+    start = time.perf_counter()
+    for i in range(1000):
+        get_status(RUN_TIME)
+    status_cost = (time.perf_counter() - start) / 1000.
+    onset = trace.get_onset()
+    latency = None
+    if detect_time is not None and expect_loss:
+        latency = detect_time - onset
+    return {'scenario': name, 'check_interval': check_interval,
+            'expect_loss': expect_loss, 'detected': detect_time is not None,
+            'false_positive': detect_time is not None and not expect_loss,
+            'missed': detect_time is None and expect_loss,
+            'latency': latency, 'checks': checks,
+            'check_cost': elapsed / max(1, checks),
+            'status_cost': status_cost}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--check-intervals", type="string",
+                    dest="checks", default="0.25,0.5,1,2.5",
+                    help="comma separated tach_check_interval values")
+    opts.add_option("-i", "--tach-loss-interval", type="float",
+                    dest="tach_loss_interval", default=3.,
+                    help="tach_loss_interval of the fan")
+    opts.add_option("-s", "--scenario", type="choice", dest="scenario",
+                    choices=sorted(SCENARIOS) + ['all'], default='all',
+                    help="scripted tach trace to play back")
+    opts.add_option("-f", "--filter", type="choice", dest="rpm_filter",
+                    choices=['none', 'ema', 'median'], default='none',
+                    help="tachometer_filter of the fan")
+    opts.add_option("-o", "--outlier-ratio", type="float",
+                    dest="outlier_ratio", default=0.,
+                    help="tachometer_outlier_ratio of the fan")
+    opts.add_option("-w", "--window", type="int", dest="window", default=5,
+                    help="tachometer_filter_window of the fan")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    checks = [float(c) for c in options.checks.split(',')]
+    print("tachometer_filter=%s tachometer_outlier_ratio=%s"
+          " tachometer_filter_window=%d" % (
+              options.rpm_filter, options.outlier_ratio, options.window))
+    scenarios = sorted(SCENARIOS)
+    if options.scenario != 'all':
+        scenarios = [options.scenario]
+    print("%-15s %7s %8s %9s %6s %12s %13s" % (
+        "scenario", "check_s", "expected", "result", "lat_s", "usec/check",
+        "usec/status"))
+    false_positives = missed = 0
+    for name in scenarios:
+        for check in checks:
+            res = run_scenario(name, check, options.tach_loss_interval,
+                               options.rpm_filter, options.outlier_ratio,
+                               options.window)
+            if res['false_positive']:
+                result = "FALSE+"
+                false_positives += 1
+            elif res['missed']:
+                result = "MISSED"
+                missed += 1
+            else:
+                result = "detected" if res['detected'] else "ok"
+            latency = "-"
+            if res['latency'] is not None:
+                latency = "%.2f" % (res['latency'],)
+            print("%-15s %7.2f %8s %9s %6s %12.2f %13.2f" % (
+                name, check, "loss" if res['expect_loss'] else "-", result,
+                latency, res['check_cost'] * 1000000.,
+                res['status_cost'] * 1000000.))
+    print("false_positives=%d missed=%d" % (false_positives, missed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Measure mcu tachometer polling load and rpm clipping for poll settings
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, random
+import klippy_mock
+
+LEGACY_POLL_TIME = 0.0015
+
+# name: extra config lines for a fan rated at rated_rpm
+MODES = {
+    'legacy': lambda rated_rpm: "tachometer_poll_interval: %s\n" % (
+        LEGACY_POLL_TIME,),
+    'max_rpm': lambda rated_rpm: "max_rpm: %s\n" % (rated_rpm,),
+}
+
+def build_config(mode, rated_rpm, ppr):
+    return ("[fan]\npin: PA0\ntachometer_pin: PC0\ntachometer_ppr: %d\n"
+            "tach_loss_action: none\n" % (ppr,)) + MODES[mode](rated_rpm)
+
+# Fans spin relatively faster at low duty than a linear fit predicts
+def fan_rpm(rated_rpm, speed):
+    return rated_rpm * speed ** .7
+
+def run_profile(mode, rated_rpm, ppr, seconds, seed=0):
+    printer = klippy_mock.setup_printer(build_config(mode, rated_rpm, ppr))
+    reactor = printer.get_reactor()
+    fan = printer.lookup_object('fan').fan
+    tachometer = fan.tachometer
+    counter = printer.freq_counters['PC0']
+    rng = random.Random(seed)
+    speeds = [0., .2, .35, .5, .75, 1.]
+    check_interval = tachometer.check_interval
+    eventtime = reactor.monotonic()
+    checks = clipped = 0
+    while eventtime < seconds:
+        speed = rng.choice(speeds)
+        fan.set_speed(eventtime, speed)
+        rpm = fan_rpm(rated_rpm, speed)
+        counter.set_rpm(rpm, ppr)
+        end_time = eventtime + rng.uniform(20., 120.)
+        while eventtime < end_time:
+            eventtime += check_interval
+            reactor.run_until(eventtime)
+            checks += 1
+            # Count the checks that read noticeably below the true rpm
+            if tachometer.raw_rpm < .98 * rpm:
+                clipped += 1
+    mcu_counter = counter._counter
+    return {'polls_per_sec': mcu_counter.get_polls() / eventtime,
+            'clipped': clipped / max(1, checks)}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--rated-rpm", type="string", dest="rated",
+                    default="2000,3000,5000,7000",
+                    help="comma separated fan rpm at full speed")
+    opts.add_option("-p", "--ppr", type="int", dest="ppr", default=2,
+                    help="tachometer_ppr of the fan")
+    opts.add_option("-s", "--seconds", type="float", dest="seconds",
+                    default=3600., help="simulated seconds of speed changes")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print("%-10s %9s %11s %9s %10s" % (
+        "mode", "rated_rpm", "polls/s/fan", "saved", "clipped"))
+    for rated in [float(r) for r in options.rated.split(',')]:
+        legacy = None
+        for mode in ('legacy', 'max_rpm'):
+            res = run_profile(mode, rated, options.ppr, options.seconds)
+            polls = res['polls_per_sec']
+            if legacy is None:
+                legacy = polls
+            print("%-10s %9.0f %11.0f %8.0f%% %9.1f%%" % (
+                mode, rated, polls, (legacy - polls) * 100. / legacy,
+                res['clipped'] * 100.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,728 @@
+# Stand-in Klipper host objects for running the fan modules off-printer
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, math, random, types, importlib, configparser
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+EXTRAS = ['fan', 'fan_generic', 'temperature_fan']
+
+BUFFER_TIME_START = 0.250
+
+class error(Exception):
+    pass
+
+class sentinel:
+    pass
+
+
+######################################################################
+# Reactor and MCU
+######################################################################
+
+class MockTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+# Simulated reactor - time only advances when run_until() is called
+class MockReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self, start_time=0.):
+        self.eventtime = start_time
+        self.timers = []
+    def monotonic(self):
+        return self.eventtime
+    def register_timer(self, callback, waketime=NEVER):
+        timer = MockTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+    def unregister_timer(self, timer):
+        self.timers.remove(timer)
+    def run_until(self, eventtime):
+        # Dispatch due timers in waketime order
+        while self.timers:
+            timer = min(self.timers, key=lambda t: t.waketime)
+            if timer.waketime > eventtime:
+                break
+            self.eventtime = max(self.eventtime, timer.waketime)
+            timer.waketime = timer.callback(self.eventtime)
+        self.eventtime = max(self.eventtime, eventtime)
+    def pause(self, waketime):
+        self.run_until(waketime)
+        return self.eventtime
+
+CLOCK_FREQ = 72000000
+PWM_MAX = 255.
+
+# MCU with a print_time clock that matches the reactor clock
+class MockMCU:
+    def __init__(self, printer, name='mcu'):
+        self.printer = printer
+        self.name = name
+        self.constants = {'CLOCK_FREQ': CLOCK_FREQ, 'PWM_MAX': PWM_MAX}
+        self.oids = []
+    def get_name(self):
+        return self.name
+    def create_oid(self, obj=None):
+        self.oids.append(obj)
+        return len(self.oids) - 1
+    def get_constant_float(self, name):
+        return float(self.constants[name])
+    def seconds_to_clock(self, time):
+        return int(time * self.constants['CLOCK_FREQ'])
+    def estimated_print_time(self, eventtime):
+        return eventtime
+    def register_config_callback(self, cb):
+        pass
+
+class MockPWM:
+    def __init__(self, mcu, pin):
+        self.mcu = mcu
+        self.pin = pin
+        self.max_duration = None
+        self.cycle_time = 0.100
+        self.hardware_pwm = False
+        self.start_value = self.shutdown_value = 0.
+        self.set_count = 0
+        self.time_errors = 0
+        self.last_time = 0.
+        self.last_value = 0.
+        self.history = None
+        self.listener = None
+    def get_mcu(self):
+        return self.mcu
+    def get_pwm_max(self):
+        if self.hardware_pwm:
+            return self.mcu.get_constant_float('PWM_MAX')
+        return float(self.mcu.seconds_to_clock(self.cycle_time))
+    def get_ticks(self):
+        # The duty value the mcu would receive for the last update
+        value = max(0., min(1., self.last_value))
+        return int(value * self.get_pwm_max() + 0.5)
+    def setup_max_duration(self, max_duration):
+        self.max_duration = max_duration
+    def setup_cycle_time(self, cycle_time, hardware_pwm=False):
+        self.cycle_time = cycle_time
+        self.hardware_pwm = hardware_pwm
+    def setup_start_value(self, start_value, shutdown_value):
+        self.start_value = self.last_value = start_value
+        self.shutdown_value = shutdown_value
+    def record(self):
+        self.history = []
+    def set_pwm(self, print_time, value):
+        if print_time < self.last_time:
+            self.time_errors += 1
+        self.set_count += 1
+        self.last_time = print_time
+        self.last_value = value
+        if self.history is not None:
+            self.history.append((print_time, value))
+        if self.listener is not None:
+            self.listener(print_time, value)
+
+class MockDigitalOut(MockPWM):
+    def set_digital(self, print_time, value):
+        self.set_pwm(print_time, value)
+
+class MockPins:
+    def __init__(self, printer):
+        self.printer = printer
+        self.mcus = {}
+        self.pins = {}
+    def get_mcu(self, name):
+        if name not in self.mcus:
+            self.mcus[name] = MockMCU(self.printer, name)
+        return self.mcus[name]
+    def setup_pin(self, pin_type, pin_desc):
+        desc = pin_desc.strip().lstrip('^~!').strip()
+        mcu_name = 'mcu'
+        if ':' in desc:
+            mcu_name, desc = [s.strip() for s in desc.split(':', 1)]
+        if (mcu_name, desc) in self.pins:
+            raise error("pin %s used multiple times in config" % (desc,))
+        mcu = self.get_mcu(mcu_name)
+        if pin_type == 'pwm':
+            pin = MockPWM(mcu, desc)
+        elif pin_type == 'digital_out':
+            pin = MockDigitalOut(mcu, desc)
+        else:
+            raise error("Unknown pin type %s" % (pin_type,))
+        self.pins[(mcu_name, desc)] = pin
+        return pin
+    def get_pins(self, pin_type):
+        return [p for p in self.pins.values() if type(p) is pin_type]
+
+
+######################################################################
+# pulse_counter stand-in
+######################################################################
+
+# Same attribute names as pulse_counter.MCU_counter.  Counts the polls
+# the mcu would run so the poll interval load can be measured.
+class MockMCUCounter:
+    def __init__(self, printer, pin, sample_time, poll_time):
+        mcu_name = 'mcu'
+        if ':' in pin:
+            mcu_name = pin.split(':', 1)[0].strip()
+        self.reactor = printer.get_reactor()
+        self._mcu = printer.lookup_object('pins').get_mcu(mcu_name)
+        self._oid = self._mcu.create_oid(self)
+        self._sample_time = sample_time
+        self._poll_time = poll_time
+        self._poll_ticks = self._mcu.seconds_to_clock(poll_time)
+    def get_polls(self):
+        return self.reactor.monotonic() / self._poll_time
+
+class MockFrequencyCounter:
+    def __init__(self, printer, pin, sample_time, poll_time):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.pin = pin
+        self.sample_time = sample_time
+        self.frequency = 0.
+        self.trace = None
+        self.ppr = 2
+        self._counter = MockMCUCounter(printer, pin, sample_time, poll_time)
+        printer.freq_counters[pin] = self
+    def get_poll_time(self):
+        return self._counter._poll_time
+    def set_rpm(self, rpm, ppr=2):
+        self.frequency = rpm * ppr / 30.
+    def set_trace(self, trace, ppr=2):
+        self.trace = trace
+        self.ppr = ppr
+    def get_frequency(self):
+        # Polling sees at most one pin change per poll, faster signals
+        # are undercounted
+        max_frequency = 1. / self._counter._poll_time
+        if self.trace is None:
+            return min(self.frequency, max_frequency)
+        # Report whole pulses counted over the last completed sample
+        sample_time = self.sample_time
+        sample_end = (self.reactor.monotonic() // sample_time) * sample_time
+        rpm = self.trace.get_rpm(sample_end - .5 * sample_time)
+        pulses = int(rpm * self.ppr / 60. * sample_time)
+        return min(pulses / sample_time, max_frequency)
+
+# Scripted fan speed used to drive MockFrequencyCounter
+class RpmTrace:
+    def __init__(self, rpm, noise=0., seed=0):
+        self.rpm = rpm
+        self.noise = noise
+        self.events = []
+        self.rng = random.Random(seed)
+    def stall(self, start):
+        self.events.append((start, None, 'stall', 0.))
+        return self
+    def dropout(self, start, duration):
+        self.events.append((start, start + duration, 'dropout', 0.))
+        return self
+    def spin_down(self, start, tau):
+        self.events.append((start, None, 'spin_down', tau))
+        return self
+    def set_speed(self, start, rpm):
+        self.events.append((start, None, 'speed', rpm))
+        return self
+    def get_onset(self):
+        return min([e[0] for e in self.events if e[2] != 'speed'],
+                   default=None)
+    def get_rpm(self, eventtime):
+        rpm = self.rpm
+        for start, end, kind, param in self.events:
+            if eventtime < start or (end is not None and eventtime >= end):
+                continue
+            if kind == 'speed':
+                rpm = param
+            elif kind == 'spin_down':
+                rpm *= math.exp(-(eventtime - start) / param)
+            else:
+                rpm = 0.
+        if rpm and self.noise:
+            rpm = max(0., rpm * (1. + self.rng.gauss(0., self.noise)))
+        return rpm
+
+# Fan rotor driven by the duty sent to a MockPWM.  A stopped fan needs
+# start_duty to turn and a running one stalls at stall_duty.  The rpm
+# is reported to the MockFrequencyCounter as whole second averages.
+class MockFanPlant:
+    def __init__(self, printer, pwm, counter, rated_rpm=3000.,
+                 stall_duty=.2, start_duty=.3, min_rpm=.25, exponent=.6,
+                 tau=1., step=.05):
+        self.reactor = printer.get_reactor()
+        self.counter = counter
+        self.rated_rpm = rated_rpm
+        self.stall_duty = stall_duty
+        self.start_duty = start_duty
+        self.min_rpm = min_rpm
+        self.exponent = exponent
+        self.tau = tau
+        self.step = step
+        self.health = 1.
+        self.updates = []
+        self.duty = self.rpm = 0.
+        self.sample_sum = 0.
+        self.samples = 0
+        pwm.listener = self._pwm_update
+        self.timer = self.reactor.register_timer(self._update,
+                                                 self.reactor.monotonic())
+    def _pwm_update(self, print_time, value):
+        self.updates.append((print_time, value))
+    def get_target_rpm(self, duty, running):
+        if duty <= (self.stall_duty if running else self.start_duty):
+            return 0.
+        frac = (duty - self.stall_duty) / (1. - self.stall_duty)
+        frac = self.min_rpm + (1. - self.min_rpm) * frac ** self.exponent
+        return self.rated_rpm * self.health * frac
+    def _update(self, eventtime):
+        while self.updates and self.updates[0][0] <= eventtime:
+            self.duty = self.updates.pop(0)[1]
+        target = self.get_target_rpm(self.duty, self.rpm > 0.)
+        self.rpm += (target - self.rpm) * self.step / self.tau
+        if not target and self.rpm < 1.:
+            self.rpm = 0.
+        self.sample_sum += self.rpm
+        self.samples += 1
+        if self.samples * self.step >= .999:
+            self.counter.set_rpm(self.sample_sum / self.samples)
+            self.sample_sum = 0.
+            self.samples = 0
+        return eventtime + self.step
+
+
+######################################################################
+# G-Code
+######################################################################
+
+class MockGCodeCommand:
+    error = error
+    def __init__(self, gcode, command, commandline, params):
+        self.gcode = gcode
+        self.command = command
+        self.commandline = commandline
+        self.params = params
+    def get_command(self):
+        return self.command
+    def get_commandline(self):
+        return self.commandline
+    def get_command_parameters(self):
+        return self.params
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg, log)
+    def respond_raw(self, msg):
+        self.gcode.respond_raw(msg)
+    def get(self, name, default=sentinel, parser=str, minval=None,
+            maxval=None, above=None, below=None):
+        value = self.params.get(name)
+        if value is None:
+            if default is sentinel:
+                raise error("Error on '%s': missing %s"
+                            % (self.commandline, name))
+            return default
+        try:
+            value = parser(value)
+        except:
+            raise error("Unable to parse '%s' as a %s" % (value, name))
+        if minval is not None and value < minval:
+            raise error("Error on '%s': %s must have minimum of %s"
+                        % (self.commandline, name, minval))
+        if maxval is not None and value > maxval:
+            raise error("Error on '%s': %s must have maximum of %s"
+                        % (self.commandline, name, maxval))
+        if above is not None and value <= above:
+            raise error("Error on '%s': %s must be above %s"
+                        % (self.commandline, name, above))
+        if below is not None and value >= below:
+            raise error("Error on '%s': %s must be below %s"
+                        % (self.commandline, name, below))
+        return value
+    def get_int(self, name, default=sentinel, minval=None, maxval=None):
+        return self.get(name, default, parser=int, minval=minval,
+                        maxval=maxval)
+    def get_float(self, name, default=sentinel, minval=None, maxval=None,
+                  above=None, below=None):
+        return self.get(name, default, parser=float, minval=minval,
+                        maxval=maxval, above=above, below=below)
+
+class MockGCode:
+    def __init__(self, printer):
+        self.printer = printer
+        self.ready_gcode_handlers = {}
+        self.mux_commands = {}
+        self.responses = []
+        self.keep_responses = True
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        if func is None:
+            self.ready_gcode_handlers.pop(cmd, None)
+            return
+        if cmd in self.ready_gcode_handlers:
+            raise error("gcode command %s already registered" % (cmd,))
+        self.ready_gcode_handlers[cmd] = func
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        prev = self.mux_commands.get(cmd)
+        if prev is None:
+            handler = lambda gcmd: self._cmd_mux(cmd, gcmd)
+            self.register_command(cmd, handler, desc=desc)
+            self.mux_commands[cmd] = prev = (key, {})
+        prev_key, prev_values = prev
+        if prev_key != key:
+            raise error("mux command %s %s %s may have only one key (%s)"
+                        % (cmd, key, value, prev_key))
+        if value in prev_values:
+            raise error("mux command %s %s %s already registered (%s)"
+                        % (cmd, key, value, prev_values))
+        prev_values[value] = func
+    def _cmd_mux(self, command, gcmd):
+        key, values = self.mux_commands[command]
+        if None in values:
+            key_param = gcmd.get(key, None)
+        else:
+            key_param = gcmd.get(key)
+        if key_param not in values:
+            raise error("The value '%s' is not valid for %s"
+                        % (key_param, key))
+        values[key_param](gcmd)
+    def respond_raw(self, msg):
+        if self.keep_responses:
+            self.responses.append(msg)
+    def respond_info(self, msg, log=True):
+        self.respond_raw("// " + msg)
+    def create_gcode_command(self, command, commandline, params):
+        return MockGCodeCommand(self, command, commandline, params)
+    def parse_line(self, line):
+        # Returns (command, params) using the Klipper parameter rules
+        line = line.split(';', 1)[0].strip()
+        if not line:
+            return None, {}
+        parts = line.split()
+        cmd = parts[0].upper()
+        if len(cmd) > 1 and cmd[0].isalpha() and cmd[1:2].isdigit():
+            params = {}
+            for word in parts[1:]:
+                params[word[0].upper()] = word[1:]
+            return cmd, params
+        params = {}
+        for word in parts[1:]:
+            if '=' in word:
+                k, v = word.split('=', 1)
+                params[k.upper()] = v
+        return cmd, params
+    def run_line(self, line):
+        cmd, params = self.parse_line(line)
+        if cmd is None:
+            return
+        handler = self.ready_gcode_handlers.get(cmd)
+        if handler is None:
+            raise error("Unknown command:\"%s\"" % (cmd,))
+        handler(MockGCodeCommand(self, cmd, line.strip(), params))
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            self.run_line(line)
+
+
+######################################################################
+# Toolhead
+######################################################################
+
+# Lookahead callbacks are queued with the end time of the last move and
+# run once the queued motion extends lookahead_time past them.  A
+# lookahead_time of zero runs them immediately (idle toolhead).  Queued
+# moves advance the reactor so that the host stays lookahead_time plus
+# BUFFER_TIME_START ahead of the mcu.
+class MockToolhead:
+    def __init__(self, printer, lookahead_time=0.):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcu = printer.lookup_object('pins').get_mcu('mcu')
+        self.lookahead_time = lookahead_time
+        self.print_time = 0.
+        self.pending = []
+        self.callback_count = 0
+    def get_last_move_time(self):
+        est = self.mcu.estimated_print_time(self.reactor.monotonic())
+        self.print_time = max(self.print_time, est + BUFFER_TIME_START)
+        return self.print_time
+    def register_lookahead_callback(self, callback):
+        self.callback_count += 1
+        if not self.lookahead_time:
+            callback(self.get_last_move_time())
+            return
+        self.pending.append((self.print_time, callback))
+    def move(self, move_time):
+        self.get_last_move_time()
+        self.print_time += move_time
+        self._check_flush(self.print_time - self.lookahead_time)
+        self.reactor.run_until(self.print_time - self.lookahead_time
+                               - BUFFER_TIME_START)
+    def dwell(self, delay):
+        self.move(delay)
+    def _check_flush(self, flush_time):
+        pending = self.pending
+        count = 0
+        while count < len(pending) and pending[count][0] <= flush_time:
+            count += 1
+        if not count:
+            return
+        ready = pending[:count]
+        del pending[:count]
+        for print_time, callback in ready:
+            callback(print_time)
+    def flush_lookahead(self):
+        self._check_flush(self.print_time)
+    def wait_moves(self):
+        self.flush_lookahead()
+        self.reactor.run_until(self.print_time)
+    def get_status(self, eventtime):
+        return {'print_time': self.print_time}
+
+
+######################################################################
+# Heaters and temperature sensors
+######################################################################
+
+REPORT_TIME = 0.300
+
+class MockSensor:
+    def __init__(self, config):
+        self.name = config.get_name()
+        self.report_time = REPORT_TIME
+        self.min_temp = self.max_temp = 0.
+        self.callback = None
+    def setup_minmax(self, min_temp, max_temp):
+        self.min_temp = min_temp
+        self.max_temp = max_temp
+    def setup_callback(self, temperature_callback):
+        self.callback = temperature_callback
+    def get_report_time_delta(self):
+        return self.report_time
+    def report(self, read_time, temp):
+        self.callback(read_time, temp)
+
+class MockHeaters:
+    def __init__(self, printer):
+        self.printer = printer
+        self.sensors = {}
+    def setup_sensor(self, config):
+        config.get('sensor_type', 'mock')
+        config.get('sensor_pin', None)
+        return MockSensor(config)
+    def register_sensor(self, config, psensor, gcode_id=None):
+        self.sensors[config.get_name()] = psensor
+    def lookup_heater(self, heater_name):
+        raise error("Unknown heater '%s'" % (heater_name,))
+
+
+######################################################################
+# Printer and config
+######################################################################
+
+class MockConfig:
+    error = error
+    def __init__(self, printer, fileconfig, section):
+        self.printer = printer
+        self.fileconfig = fileconfig
+        self.section = section
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.section
+    def _get_wrapper(self, parser, option, default, minval=None, maxval=None,
+                     above=None, below=None):
+        if not self.fileconfig.has_option(self.section, option):
+            if default is not sentinel:
+                return default
+            raise error("Option '%s' in section '%s' must be specified"
+                        % (option, self.section))
+        try:
+            v = parser(self.section, option)
+        except error:
+            raise
+        except:
+            raise error("Unable to parse option '%s' in section '%s'"
+                        % (option, self.section))
+        if minval is not None and v < minval:
+            raise error("Option '%s' in section '%s' must have minimum of %s"
+                        % (option, self.section, minval))
+        if maxval is not None and v > maxval:
+            raise error("Option '%s' in section '%s' must have maximum of %s"
+                        % (option, self.section, maxval))
+        if above is not None and v <= above:
+            raise error("Option '%s' in section '%s' must be above %s"
+                        % (option, self.section, above))
+        if below is not None and v >= below:
+            raise error("Option '%s' in section '%s' must be below %s"
+                        % (option, self.section, below))
+        return v
+    def get(self, option, default=sentinel):
+        return self._get_wrapper(self.fileconfig.get, option, default)
+    def getint(self, option, default=sentinel, minval=None, maxval=None):
+        return self._get_wrapper(self.fileconfig.getint, option, default,
+                                 minval, maxval)
+    def getfloat(self, option, default=sentinel, minval=None, maxval=None,
+                 above=None, below=None):
+        return self._get_wrapper(self.fileconfig.getfloat, option, default,
+                                 minval, maxval, above, below)
+    def getboolean(self, option, default=sentinel):
+        return self._get_wrapper(self.fileconfig.getboolean, option, default)
+    def getchoice(self, option, choices, default=sentinel):
+        if type(choices) == type([]):
+            choices = {i: i for i in choices}
+        if choices and type(list(choices.keys())[0]) == int:
+            c = self.getint(option, default)
+        else:
+            c = self.get(option, default)
+        if c not in choices:
+            raise error("Choice '%s' for option '%s' in section '%s'"
+                        " is not a valid choice" % (c, option, self.section))
+        return choices[c]
+    def getlists(self, option, default=sentinel, seps=(',',), count=None,
+                 parser=str):
+        def lparser(value, pos):
+            if len(value.strip()) == 0:
+                return ()
+            parts = [p.strip() for p in value.split(seps[pos])]
+            if pos:
+                # Nested list
+                return tuple([lparser(p, pos - 1) for p in parts if p])
+            res = [parser(p) for p in parts]
+            if count is not None and len(res) != count:
+                raise error("Option '%s' in section '%s' must have %d"
+                            " elements" % (option, self.section, count))
+            return tuple(res)
+        def fcparser(section, option):
+            return lparser(self.fileconfig.get(section, option),
+                           len(seps) - 1)
+        return self._get_wrapper(fcparser, option, default)
+    def getsection(self, section):
+        return MockConfig(self.printer, self.fileconfig, section)
+    def has_section(self, section):
+        return self.fileconfig.has_section(section)
+    def get_prefix_sections(self, prefix):
+        return [self.getsection(s) for s in self.fileconfig.sections()
+                if s.startswith(prefix)]
+
+# Options stored for SAVE_CONFIG
+class MockConfigFile:
+    def __init__(self):
+        self.autosave = {}
+    def set(self, section, option, value):
+        self.autosave.setdefault(section, {})[option] = str(value)
+    def get_autosave_text(self):
+        lines = []
+        for section, options in sorted(self.autosave.items()):
+            lines.append("[%s]" % (section,))
+            lines += ["%s: %s" % item for item in sorted(options.items())]
+        return "\n".join(lines) + "\n"
+
+class MockPrinter:
+    config_error = error
+    command_error = error
+    def __init__(self, lookahead_time=0.):
+        self.reactor = MockReactor()
+        self.objects = {}
+        self.event_handlers = {}
+        self.freq_counters = {}
+        self.shutdown_reason = None
+        self.shutdown_count = 0
+        self.shutdown_time = None
+        self.objects['pins'] = MockPins(self)
+        self.objects['configfile'] = MockConfigFile()
+        self.objects['gcode'] = MockGCode(self)
+        self.objects['heaters'] = MockHeaters(self)
+        self.objects['toolhead'] = MockToolhead(self, lookahead_time)
+    def get_reactor(self):
+        return self.reactor
+    def add_object(self, name, obj):
+        if name in self.objects:
+            raise error("Printer object '%s' already created" % (name,))
+        self.objects[name] = obj
+    def lookup_object(self, name, default=sentinel):
+        if name in self.objects:
+            return self.objects[name]
+        if default is sentinel:
+            raise error("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        prefix = module + ' '
+        return [(n, o) for n, o in self.objects.items()
+                if n.startswith(prefix) or n == module]
+    def load_object(self, config, section, default=sentinel):
+        if section in self.objects:
+            return self.objects[section]
+        module_parts = section.split()
+        module_name = module_parts[0]
+        if module_name not in EXTRAS:
+            if default is sentinel:
+                raise error("Unable to load module '%s'" % (section,))
+            return default
+        mod = load_extras()[module_name]
+        init_func = 'load_config'
+        if len(module_parts) > 1:
+            init_func = 'load_config_prefix'
+        init_func = getattr(mod, init_func, None)
+        if init_func is None:
+            if default is sentinel:
+                raise error("Unable to load module '%s'" % (section,))
+            return default
+        self.objects[section] = init_func(config.getsection(section))
+        return self.objects[section]
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        self.shutdown_count += 1
+        if self.shutdown_reason is None:
+            self.shutdown_reason = msg
+            self.shutdown_time = self.reactor.monotonic()
+    def is_shutdown(self):
+        return self.shutdown_reason is not None
+
+# Stand-in packages the fan modules can be imported from (package name:
+# source directory), and the one used by new printers.  Other sources
+# let bench_compare.py time two revisions in the same process.
+SOURCES = {'extras': SRCDIR}
+active_source = 'extras'
+
+def add_source(package, srcdir):
+    SOURCES[package] = srcdir
+
+def use_source(package):
+    global active_source
+    active_source = package
+
+# Import the repo's fan modules as members of a stand-in "extras" package
+def load_extras():
+    package = active_source
+    if package not in sys.modules:
+        pkg = types.ModuleType(package)
+        pkg.__path__ = [SOURCES[package]]
+        sys.modules[package] = pkg
+        pulse_counter = types.ModuleType(package + '.pulse_counter')
+        pulse_counter.FrequencyCounter = MockFrequencyCounter
+        sys.modules[package + '.pulse_counter'] = pulse_counter
+        pkg.pulse_counter = pulse_counter
+    return {name: importlib.import_module(package + '.' + name)
+            for name in EXTRAS}
+
+# Build a printer from config text and run the connect phase
+def setup_printer(config_text, lookahead_time=0., connect=True):
+    load_extras()
+    fileconfig = configparser.RawConfigParser(strict=False,
+                                              inline_comment_prefixes=(';',
+                                                                       '#'))
+    fileconfig.read_string(config_text)
+    printer = MockPrinter(lookahead_time)
+    config = MockConfig(printer, fileconfig, 'printer')
+    for section in fileconfig.sections():
+        printer.load_object(config, section)
+    if connect:
+        printer.send_event("klippy:connect")
+        printer.send_event("klippy:ready")
+    return printer
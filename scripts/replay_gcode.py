@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# Replay a sliced G-code file and count the fan generated MCU traffic
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, math, time
+import klippy_mock, bench_fan
+
+DEFAULT_FEEDRATE = 1500.
+
+PROBES = {}
+
+# Wrap Fan.set_speed once so probes see the print_time each update was
+# requested for (fan instances use __slots__ so cannot be patched)
+def install_probe_hook(fan_class):
+    if getattr(fan_class.set_speed, 'probe_hook', False):
+        return
+    orig_set_speed = fan_class.set_speed
+    def set_speed(fan, print_time, value):
+        probe = PROBES.get(id(fan))
+        if probe is not None:
+            probe.note_request(print_time)
+        orig_set_speed(fan, print_time, value)
+    set_speed.probe_hook = True
+    fan_class.set_speed = set_speed
+
+# Tracks the PWM updates of one fan relative to the print_time that
+# requested them
+class FanProbe:
+    def __init__(self, name, fan, toolhead):
+        self.name = name
+        self.fan = fan
+        self.toolhead = toolhead
+        self.request_time = None
+        self.updates = 0
+        self.kick_base = fan.kick_count
+        self.delay_total = self.delay_max = 0.
+        self.delays = None
+        install_probe_hook(type(fan))
+        PROBES[id(fan)] = self
+        fan.mcu_fan.listener = self.note_pwm
+    def record_delays(self):
+        # Keep (requested print_time, delay) for every update
+        self.delays = []
+    def note_request(self, print_time):
+        self.request_time = print_time
+    def note_pwm(self, print_time, value):
+        request_time = self.request_time
+        if request_time is None:
+            # Kick-start, ramp step or deferred update - kick-starts are
+            # counted by the fan itself
+            return
+        self.request_time = None
+        self.updates += 1
+        delay = print_time - request_time
+        self.delay_total += delay
+        self.delay_max = max(self.delay_max, delay)
+        if self.delays is not None:
+            self.delays.append((request_time, delay))
+    def get_stats(self):
+        enable_pin = self.fan.enable_pin
+        return {
+            'set_pwm': self.fan.mcu_fan.set_count, 'updates': self.updates,
+            'kick_starts': self.fan.kick_count - self.kick_base,
+            'enable_toggles': enable_pin.set_count if enable_pin else 0,
+            'delay_mean': self.delay_total / max(1, self.updates),
+            'delay_max': self.delay_max,
+            'final_lag': max(0., self.fan.last_fan_time
+                             - self.toolhead.print_time),
+        }
+
+def lookup_fans(printer):
+    fans = {}
+    for name, obj in printer.lookup_objects():
+        fan = getattr(obj, 'fan', None)
+        if fan is not None and hasattr(fan, 'mcu_fan'):
+            fans[name] = fan
+    return fans
+
+# Minimal motion planner - estimates move durations from feedrate only
+class MotionModel:
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+        self.pos = [0., 0., 0., 0.]
+        self.absolute = self.absolute_e = True
+        self.feedrate = DEFAULT_FEEDRATE
+        self.moves = 0
+    def move(self, params):
+        pos = self.pos
+        dist2 = edist = 0.
+        for i, axis in enumerate('XYZE'):
+            if axis not in params:
+                continue
+            v = float(params[axis])
+            if not (self.absolute_e if i == 3 else self.absolute):
+                v += pos[i]
+            d = v - pos[i]
+            pos[i] = v
+            if i < 3:
+                dist2 += d * d
+            else:
+                edist = abs(d)
+        if 'F' in params:
+            self.feedrate = float(params['F'])
+        # Extrude only moves are timed on the filament distance
+        dist = math.sqrt(dist2) if dist2 else edist
+        if dist and self.feedrate > 0.:
+            self.moves += 1
+            self.toolhead.move(dist * 60. / self.feedrate)
+    def dwell(self, params):
+        if 'P' in params:
+            delay = float(params['P']) / 1000.
+        else:
+            delay = float(params.get('S', 0.))
+        if delay > 0.:
+            self.toolhead.dwell(delay)
+
+def replay(printer, f):
+    gcode = printer.lookup_object('gcode')
+    toolhead = printer.lookup_object('toolhead')
+    motion = MotionModel(toolhead)
+    parse_line = gcode.parse_line
+    lines = fan_cmds = errors = 0
+    for line in f:
+        lines += 1
+        c = line[:1]
+        if c == 'G' or c == 'g':
+            cmd, params = parse_line(line)
+            if cmd in ('G0', 'G1'):
+                motion.move(params)
+            elif cmd == 'G4':
+                motion.dwell(params)
+            elif cmd == 'G90':
+                motion.absolute = motion.absolute_e = True
+            elif cmd == 'G91':
+                motion.absolute = motion.absolute_e = False
+            elif cmd == 'G92':
+                for i, axis in enumerate('XYZE'):
+                    if axis in params:
+                        motion.pos[i] = float(params[axis])
+        elif c == 'M' or c == 'm':
+            cmd, params = parse_line(line)
+            if cmd in ('M106', 'M107'):
+                fan_cmds += 1
+                try:
+                    gcode.run_line(line)
+                except klippy_mock.error:
+                    errors += 1
+            elif cmd == 'M82':
+                motion.absolute_e = True
+            elif cmd == 'M83':
+                motion.absolute_e = False
+        elif c == 'S' and line.startswith('SET_FAN_SPEED'):
+            fan_cmds += 1
+            try:
+                gcode.run_line(line)
+            except klippy_mock.error:
+                errors += 1
+    toolhead.wait_moves()
+    return {'lines': lines, 'fan_commands': fan_cmds, 'errors': errors,
+            'moves': motion.moves, 'print_time': toolhead.print_time,
+            'callbacks': toolhead.callback_count}
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", type="string", dest="config",
+                    help="Klipper config file with the fan sections to use")
+    opts.add_option("-l", "--lookahead-time", type="float",
+                    dest="lookahead_time", default=2.,
+                    help="seconds of motion buffered ahead of callbacks")
+    opts.add_option("-e", "--enable-pin", action="store_true",
+                    dest="enable_pin", help="configure a [fan] enable pin"
+                    " when no config file is given")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    if options.config:
+        with open(options.config) as cf:
+            config_text = cf.read()
+    else:
+        config_text = bench_fan.build_config(1, options.enable_pin)
+    printer = klippy_mock.setup_printer(config_text, options.lookahead_time)
+    printer.lookup_object('gcode').keep_responses = False
+    toolhead = printer.lookup_object('toolhead')
+    probes = [FanProbe(name, fan, toolhead)
+              for name, fan in sorted(lookup_fans(printer).items())]
+    start = time.perf_counter()
+    with open(args[0], 'r', errors='replace') as f:
+        res = replay(printer, f)
+    elapsed = time.perf_counter() - start
+    print("lines=%d moves=%d fan_commands=%d errors=%d elapsed=%.2fs"
+          " (%.0f lines/s)" % (res['lines'], res['moves'],
+                               res['fan_commands'], res['errors'], elapsed,
+                               res['lines'] / max(elapsed, 1e-9)))
+    print("print_time=%.1fs lookahead_callbacks=%d" % (
+        res['print_time'], res['callbacks']))
+    for probe in probes:
+        s = probe.get_stats()
+        print("[%s] set_pwm=%d updates=%d kick_starts=%d enable_toggles=%d"
+              % (probe.name, s['set_pwm'], s['updates'], s['kick_starts'],
+                 s['enable_toggles']))
+        print("[%s] FAN_MIN_TIME push: mean=%.4fs max=%.4fs"
+              " final_lag=%.4fs" % (probe.name, s['delay_mean'],
+                                    s['delay_max'], s['final_lag']))
+
+if __name__ == '__main__':
+    main()
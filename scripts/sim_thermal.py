@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Closed-loop thermal plant simulation for temperature_fan controllers
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, math, time
+import klippy_mock
+
+CONTROLLERS = {
+    'watermark': "control: watermark\nmax_delta: 2.0\n",
+    'pid': "control: pid\npid_Kp: 40\npid_Ki: 0.2\npid_Kd: 0.1\n",
+    'slope_linear': "control: slope\nslope: linear\n",
+    'slope_log': "control: slope\nslope: log\n",
+    'slope_exponential': "control: slope\nslope: exponential\n",
+}
+
+def build_config(control, target_temp=40., min_speed=0.3, extra=""):
+    return ("[temperature_fan sim]\npin: PA0\nsensor_type: sim\n"
+            "min_temp: 0\nmax_temp: 100\ntarget_temp: %s\nmin_speed: %s\n"
+            "max_speed: 1.0\n%s%s" % (target_temp, min_speed,
+                                      CONTROLLERS[control], extra))
+
+# Lumped two node thermal model.  Node 1 (the sensed part) is heated by
+# the source and cooled into node 2 (enclosure air) by natural plus fan
+# forced convection.  Node 2 leaks to ambient.  With order=1 node 2 is
+# held at ambient.
+class ThermalPlant:
+    def __init__(self, order=2, power=20., ambient=25., capacity=200.,
+                 g_natural=0.3, g_fan=3., air_capacity=2000., g_out=4.):
+        self.order = order
+        self.power = power
+        self.ambient = ambient
+        self.capacity = capacity
+        self.g_natural = g_natural
+        self.g_fan = g_fan
+        self.air_capacity = air_capacity
+        self.g_out = g_out
+        self.temp = self.air_temp = ambient
+    def step(self, dt, airflow):
+        # Exact exponential update of each node with the other held
+        g = self.g_natural + self.g_fan * airflow
+        t_eq = self.air_temp + self.power / g
+        self.temp = t_eq + (self.temp - t_eq) * math.exp(
+            -g * dt / self.capacity)
+        if self.order < 2:
+            return self.temp
+        g_total = g + self.g_out
+        a_eq = (g * self.temp + self.g_out * self.ambient) / g_total
+        self.air_temp = a_eq + (self.air_temp - a_eq) * math.exp(
+            -g_total * dt / self.air_capacity)
+        return self.temp
+
+# Applies PWM updates to the plant at their scheduled print time
+class FanActuator:
+    def __init__(self, mcu_fan):
+        self.pending = []
+        self.duty = 0.
+        mcu_fan.listener = self.note_pwm
+    def note_pwm(self, print_time, value):
+        self.pending.append((print_time, value))
+    def update(self, eventtime):
+        pending = self.pending
+        while pending and pending[0][0] <= eventtime:
+            self.duty = pending.pop(0)[1]
+        return self.duty
+
+def analyze(samples, target, band):
+    temps = [t for _, t in samples]
+    tail = temps[-max(1, len(temps) // 10):]
+    steady = sum(tail) / len(tail)
+    settle = 0.
+    for eventtime, temp in samples:
+        if abs(temp - steady) > band:
+            settle = eventtime
+    return {'steady_temp': steady, 'steady_error': steady - target,
+            'overshoot': max(0., max(temps) - steady),
+            'settle_time': settle}
+
+def simulate(control, hours, plant, report_time=klippy_mock.REPORT_TIME,
+             target_temp=40., band=1., sample_interval=10.):
+    printer = klippy_mock.setup_printer(build_config(control, target_temp))
+    tfan = printer.lookup_object('temperature_fan sim')
+    sensor = tfan.sensor
+    sensor.report_time = tfan.speed_delay = report_time
+    actuator = FanActuator(tfan.fan.mcu_fan)
+    callback = sensor.callback
+    steps = int(hours * 3600. / report_time)
+    sample_steps = max(1, int(sample_interval / report_time))
+    samples = []
+    eventtime = 0.
+    start = time.perf_counter()
+    for i in range(steps):
+        eventtime += report_time
+        temp = plant.step(report_time, actuator.update(eventtime))
+        callback(eventtime, temp)
+        if not i % sample_steps:
+            samples.append((eventtime, temp))
+    elapsed = time.perf_counter() - start
+    res = analyze(samples, target_temp, band)
+    res.update({'control': control, 'elapsed': elapsed,
+                'sim_hours_per_sec': hours / elapsed, 'callbacks': steps,
+                'set_pwm': tfan.fan.mcu_fan.set_count})
+    return res
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--control", type="choice", dest="control",
+                    choices=sorted(CONTROLLERS) + ['all'], default='all',
+                    help="controller to simulate (or 'all')")
+    opts.add_option("-H", "--hours", type="float", dest="hours", default=2.,
+                    help="simulated hours per controller")
+    opts.add_option("-o", "--order", type="int", dest="order", default=2,
+                    help="thermal model order (1 or 2)")
+    opts.add_option("-p", "--power", type="float", dest="power", default=20.,
+                    help="heat source power in watts")
+    opts.add_option("-a", "--ambient", type="float", dest="ambient",
+                    default=25., help="ambient temperature")
+    opts.add_option("-t", "--target", type="float", dest="target",
+                    default=40., help="target_temp of the fan")
+    opts.add_option("-r", "--report-time", type="float", dest="report_time",
+                    default=klippy_mock.REPORT_TIME,
+                    help="sensor report interval in seconds")
+    opts.add_option("-b", "--band", type="float", dest="band", default=1.,
+                    help="settling band in degrees")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if options.order not in (1, 2):
+        opts.error("Order must be 1 or 2")
+    controls = sorted(CONTROLLERS)
+    if options.control != 'all':
+        controls = [options.control]
+    print("%-18s %9s %9s %9s %9s %8s %9s" % (
+        "control", "settle_s", "overshoot", "ss_error", "ss_temp", "set_pwm",
+        "sim_h/s"))
+    for control in controls:
+        plant = ThermalPlant(options.order, options.power, options.ambient)
+        res = simulate(control, options.hours, plant, options.report_time,
+                       options.target, options.band)
+        print("%-18s %9.1f %9.2f %9.2f %9.2f %8d %9.1f" % (
+            control, res['settle_time'], res['overshoot'],
+            res['steady_error'], res['steady_temp'], res['set_pwm'],
+            res['sim_hours_per_sec']))
+
+if __name__ == '__main__':
+    main()
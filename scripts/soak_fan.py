@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Long duration soak of fan update latency behind the motion queue
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, random, time
+import klippy_mock, replay_gcode
+
+CONFIG = """
+[fan]
+pin: PA0
+[fan aux]
+pin: PA1
+slicer_fan_number: 1
+[fan_generic exhaust]
+pin: PA2
+"""
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.))
+    return sorted_values[idx]
+
+# Synthetic print: features made of short moves, with a burst of fan
+# commands at each feature boundary as slicers emit them
+def run_job(printer, hours, seed=0, move_time=.15, burst=4,
+            aux_interval=300.):
+    rng = random.Random(seed)
+    gcode = printer.lookup_object('gcode')
+    toolhead = printer.lookup_object('toolhead')
+    def make(line):
+        cmd, params = gcode.parse_line(line)
+        return (gcode.ready_gcode_handlers[cmd],
+                gcode.create_gcode_command(cmd, line, params))
+    part_cmds = [make("M106 S%d" % (s,)) for s in range(0, 256, 5)]
+    aux_cmds = [make("M106 T1 S%d" % (s,)) for s in (0, 128, 255)]
+    exhaust_cmds = [make("SET_FAN_SPEED FAN=exhaust SPEED=%.2f" % (s,))
+                    for s in (0., .3, .6, 1.)]
+    end_time = hours * 3600.
+    next_aux = aux_interval
+    commands = 0
+    while toolhead.print_time < end_time:
+        for i in range(rng.randint(5, 60)):
+            toolhead.move(rng.expovariate(1. / move_time))
+        for i in range(rng.randint(1, burst)):
+            handler, gcmd = rng.choice(part_cmds)
+            handler(gcmd)
+            commands += 1
+            if rng.random() < .5:
+                toolhead.move(.005)
+        if toolhead.print_time >= next_aux:
+            next_aux += aux_interval
+            for handler, gcmd in (rng.choice(aux_cmds),
+                                  rng.choice(exhaust_cmds)):
+                handler(gcmd)
+                commands += 1
+    toolhead.wait_moves()
+    return commands
+
+def summarize(probe, hours):
+    delays = probe.delays
+    values = sorted(d for t, d in delays)
+    # Worst delay in each hour shows whether the latency keeps growing
+    hourly = [0.] * (int(hours) + 1)
+    for t, d in delays:
+        idx = min(len(hourly) - 1, int(t / 3600.))
+        hourly[idx] = max(hourly[idx], d)
+    return {'updates': len(values),
+            'mean': sum(values) / max(1, len(values)),
+            'p50': percentile(values, 50.), 'p99': percentile(values, 99.),
+            'p999': percentile(values, 99.9),
+            'max': values[-1] if values else 0., 'hourly': hourly}
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-H", "--hours", type="float", dest="hours", default=24.,
+                    help="simulated job length in hours")
+    opts.add_option("-l", "--lookahead-time", type="float",
+                    dest="lookahead_time", default=2.,
+                    help="seconds of motion buffered ahead of callbacks")
+    opts.add_option("-m", "--move-time", type="float", dest="move_time",
+                    default=.15, help="mean move duration in seconds")
+    opts.add_option("-b", "--burst", type="int", dest="burst", default=4,
+                    help="maximum M106 commands per feature boundary")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="random seed of the synthetic job")
+    opts.add_option("--limit", type="float", dest="limit", default=0.,
+                    help="fail if any fan's p99 delay exceeds this (seconds)")
+    opts.add_option("--hourly", action="store_true", dest="hourly",
+                    help="print the worst delay for every simulated hour")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    printer = klippy_mock.setup_printer(CONFIG, options.lookahead_time)
+    toolhead = printer.lookup_object('toolhead')
+    probes = []
+    for name, fan in sorted(replay_gcode.lookup_fans(printer).items()):
+        probe = replay_gcode.FanProbe(name, fan, toolhead)
+        probe.record_delays()
+        probes.append(probe)
+    start = time.perf_counter()
+    commands = run_job(printer, options.hours, options.seed,
+                       options.move_time, options.burst)
+    elapsed = time.perf_counter() - start
+    print("simulated %.1fh (%d fan commands) in %.2fs" % (
+        toolhead.print_time / 3600., commands, elapsed))
+    print("%-22s %8s %8s %8s %8s %8s %8s" % (
+        "fan", "updates", "mean_s", "p50_s", "p99_s", "p999_s", "max_s"))
+    failed = False
+    for probe in probes:
+        res = summarize(probe, options.hours)
+        print("%-22s %8d %8.4f %8.4f %8.4f %8.4f %8.4f" % (
+            probe.name, res['updates'], res['mean'], res['p50'], res['p99'],
+            res['p999'], res['max']))
+        if options.hourly:
+            print("  hourly max: " + " ".join("%.3f" % (d,)
+                                              for d in res['hourly']))
+        if options.limit and res['p99'] > options.limit:
+            failed = True
+    if failed:
+        print("p99 fan delay exceeds %.3fs" % (options.limit,))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Randomized stress test of Fan.set_speed timing invariants
+#
+# Copyright (C) 2024  TheFuzzyGiggler <github.com/TheFuzzyGiggler>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, optparse, random, time
+import klippy_mock
+
+def random_config(rng):
+    lines = ["[fan]", "pin: PA0"]
+    if rng.random() < .5:
+        lines.append("enable_pin: PB0")
+    lines.append("kick_start_time: %s" % (rng.choice([0., .05, .1, .5]),))
+    if rng.random() < .1:
+        lines.append("kick_start_profile: 1.0, 0.1\n  0.6, 0.2")
+    lines.append("off_below: %s" % (rng.choice([0., 0., .1, .3]),))
+    lines.append("max_power: %s" % (rng.choice([1., 1., .8, .5]),))
+    if rng.random() < .3:
+        lines.append("hardware_pwm: True")
+    if rng.random() < .3:
+        lines.append("speed_deadband: %s" % (rng.choice([.02, .1]),))
+    if rng.random() < .3:
+        lines.append("min_update_interval: %s" % (rng.choice([.5, 2.]),))
+    if rng.random() < .1:
+        lines.append("immediate: True")
+    if rng.random() < .3:
+        lines.append("ramp_rate: %s" % (rng.choice([.5, 2., 10.]),))
+        lines.append("ramp_max_steps: %d" % (rng.choice([2, 10, 50]),))
+    if rng.random() < .3:
+        lines += ["tachometer_pin: PC0", "tach_loss_action: none"]
+    return "\n".join(lines) + "\n"
+
+def random_value(rng):
+    r = rng.random()
+    if r < .25:
+        return 0.
+    if r < .4:
+        return 1.
+    if r < .5:
+        return rng.choice([.05, .1, .3])
+    return rng.randint(0, 255) / 255.
+
+def check(cond, failures, msg):
+    if not cond:
+        failures.append(msg)
+
+# Apply one random storm of fan operations and verify the invariants.
+# Returns (operations, failures).
+def run_case(seed, ops):
+    rng = random.Random(seed)
+    config_text = random_config(rng)
+    lookahead_time = rng.choice([0., 0., .5, 2.])
+    printer = klippy_mock.setup_printer(config_text, lookahead_time)
+    toolhead = printer.lookup_object('toolhead')
+    fan = printer.lookup_object('fan').fan
+    pwm = fan.mcu_fan
+    enable = fan.enable_pin
+    print_time = 1.
+    requested = 0.
+    direct_updates = 0
+    for i in range(ops):
+        op = rng.random()
+        # Mostly advancing print times, with some stale requests
+        print_time = max(0., print_time + rng.uniform(-.05, .2))
+        if op < .4 or op >= .85:
+            # Direct callers obtain print_time via get_last_move_time(),
+            # which flushes the lookahead queue first
+            toolhead.flush_lookahead()
+        if op < .4:
+            requested = random_value(rng)
+            fan.set_speed(print_time, requested)
+            direct_updates += 1
+        elif op < .8:
+            requested = random_value(rng)
+            fan.set_speed_from_command(requested)
+            toolhead.move(rng.uniform(0., .3))
+        elif op < .85:
+            # Overrides the commands still queued behind the moves
+            requested = random_value(rng)
+            fan.set_speed_from_command(requested, True)
+            direct_updates += 1
+        elif op < .9:
+            requested = 0.
+            printer.send_event("gcode:request_restart", print_time)
+            direct_updates += 1
+        else:
+            # Force a kick-start or an enable pin transition
+            fan.set_speed(print_time, 0.)
+            requested = rng.choice([.2, .6, 1.])
+            fan.set_speed(print_time, requested)
+            direct_updates += 2
+    toolhead.flush_lookahead()
+    reactor = printer.get_reactor()
+    reactor.run_until(max(pwm.last_time, toolhead.print_time) + 60.)
+    updates = direct_updates + toolhead.callback_count
+    failures = []
+    check(pwm.time_errors == 0, failures,
+          "pwm scheduled backwards %d times" % (pwm.time_errors,))
+    # A kick-start sends one message per profile step plus the final
+    # duty, a ramp up to ramp_max_steps
+    per_update = max(2, len(fan.kick_profile) + 1,
+                     fan.ramp_max_steps if fan.ramp_rate else 0)
+    check(pwm.set_count <= per_update * updates, failures,
+          "set_pwm volume %d exceeds %d x %d updates"
+          % (pwm.set_count, per_update, updates))
+    check(fan.last_fan_value == requested, failures,
+          "reported speed %s != final request %s"
+          % (fan.last_fan_value, requested))
+    # The final duty must match a fresh fan given only the final request
+    ref_printer = klippy_mock.setup_printer(config_text)
+    ref = ref_printer.lookup_object('fan').fan
+    ref.set_speed(1., requested)
+    ref_printer.get_reactor().run_until(60.)
+    check(pwm.get_ticks() == ref.mcu_fan.get_ticks(), failures,
+          "final duty %s != expected %s for speed %s"
+          % (pwm.get_ticks(), ref.mcu_fan.get_ticks(), requested))
+    if enable is not None:
+        check(enable.time_errors == 0, failures,
+              "enable pin scheduled backwards %d times"
+              % (enable.time_errors,))
+        check(enable.set_count <= updates, failures,
+              "enable pin volume %d exceeds %d updates"
+              % (enable.set_count, updates))
+        check(enable.last_value == (1 if requested > 0. else 0), failures,
+              "enable pin %s for final speed %s"
+              % (enable.last_value, requested))
+    return updates, failures
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--cases", type="int", dest="cases", default=500,
+                    help="number of random cases")
+    opts.add_option("-n", "--ops", type="int", dest="ops", default=400,
+                    help="operations per case")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                    help="seed of the first case (rerun one with -c 1)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    total = 0
+    failed = 0
+    start = time.perf_counter()
+    for seed in range(options.seed, options.seed + options.cases):
+        updates, failures = run_case(seed, options.ops)
+        total += updates
+        if failures:
+            failed += 1
+            print("seed %d:" % (seed,))
+            for msg in failures:
+                print("  " + msg)
+    elapsed = time.perf_counter() - start
+    print("cases=%d failed=%d updates=%d elapsed=%.2fs (%.0f updates/s)" % (
+        options.cases, failed, total, elapsed, total / elapsed))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
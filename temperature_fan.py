@@ -21,6 +21,12 @@ PID_PARAM_BASE = 255.
 MAX_TEMP_BUFFER = .8
 
 class TemperatureFan:
+    __slots__ = ('name', 'printer', 'fan', 'min_temp', 'max_temp',
+                 'min_temp_cutoff', 'target_temp_conf', 'target_temp',
+                 'last_temp', 'last_temp_time', 'heaters', 'sensor',
+                 'next_speed_time', 'last_speed_value', 'speed_delay',
+                 'max_speed_conf', 'max_speed', 'min_speed_conf', 'min_speed',
+                 'control', 'slicer_fan_num')
     def __init__(self, config):
         self.name = config.get_name().split()[1]
         self.printer = config.get_printer()
@@ -71,9 +77,8 @@ class TemperatureFan:
         self.control = algo(self, config)
         ###################################
 
+        # Slicer fan registration is handled by Fan.handle_connect
         self.slicer_fan_num = config.getint('slicer_fan_number', default=None)
-        if self.slicer_fan_num is not None:
-            self.printer.lookup_object('fan').add_fan(self.slicer_fan_num,self.fan)
         gcode = self.printer.lookup_object('gcode')
         gcode.register_mux_command(
             "SET_TEMPERATURE_FAN_TARGET", "TEMPERATURE_FAN", self.name,
@@ -151,6 +156,7 @@ class TemperatureFan:
 ######################################################################
 
 class ControlBangBang:
+    __slots__ = ('temperature_fan', 'max_delta', 'heating')
     def __init__(self, temperature_fan, config):
         self.temperature_fan = temperature_fan
         self.max_delta = config.getfloat('max_delta', 2.0, above=0.)
@@ -183,6 +189,9 @@ PID_SETTLE_DELTA = 1.
 PID_SETTLE_SLOPE = .1
 
 class ControlPID:
+    __slots__ = ('temperature_fan', 'Kp', 'Ki', 'Kd', 'min_deriv_time',
+                 'temp_integ_max', 'prev_temp', 'prev_temp_time',
+                 'prev_temp_deriv', 'prev_temp_integ')
     def __init__(self, temperature_fan, config):
         self.temperature_fan = temperature_fan
         self.Kp = config.getfloat('pid_Kp') / PID_PARAM_BASE
@@ -235,6 +244,8 @@ class ControlPID:
 ######################################################################
 
 class ControlSlope:
+    __slots__ = ('temperature_fan', 'min_speed', 'min_temp_cutoff', 'min_temp',
+                 'algo', 'max_temp')
     def __init__(self, temperature_fan, config):
         self.temperature_fan = temperature_fan
         self.min_speed = self.temperature_fan.min_speed